@@ -0,0 +1,78 @@
+"""
+Benchmark fetching speech through the prefetcher at varying concurrency.
+
+Requests go to a local stub server with a fixed response delay, so the
+results measure the fetch pipeline rather than google. Each concurrency
+level starts with an empty audio cache.
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from common import StubServer, percentile, presenter, repo_dir, result
+
+
+class TimedBackend(presenter.HTTPBackend):
+    """HTTPBackend that records the latency of each request."""
+    def __init__(self, *args, **kwargs):
+        presenter.HTTPBackend.__init__(self, *args, **kwargs)
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def synthesize(self, text, language):
+        start = time.perf_counter()
+        try:
+            return presenter.HTTPBackend.synthesize(self, text, language)
+        finally:
+            with self.lock:
+                self.latencies.append(time.perf_counter() - start)
+
+
+def run(args):
+    """Fetch args.clips paragraphs at each concurrency level."""
+    with open(os.path.join(repo_dir, "pico_1.wav"), "rb") as f:
+        body = f.read()
+    server = StubServer(body, args.stub_delay)
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            folder = tempfile.mkdtemp(prefix="bench_fetch_")
+            cache = presenter.AudioCache(folder, 1 << 30)
+            pool = presenter.HTTPPool(pool_size=concurrency)
+            backend = TimedBackend(server.url, max_concurrency=concurrency,
+                                   pool=pool)
+            prefetcher = presenter.Prefetcher(cache, depth=concurrency,
+                                              workers=concurrency,
+                                              backend=backend)
+            playlist = [["en", "Benchmark paragraph number {}.".format(i), i]
+                        for i in range(args.clips)]
+            failed = 0
+            start = time.perf_counter()
+            try:
+                for item, futures in prefetcher.iterate(playlist):
+                    for future in futures:
+                        if future.result() is None:
+                            failed += 1
+            finally:
+                prefetcher.shutdown(wait=True)
+                pool.close()
+            elapsed = time.perf_counter() - start
+            shutil.rmtree(folder)
+
+            latencies_ms = [t * 1000 for t in backend.latencies]
+            results.append(result(
+                "fetch", "fetch_concurrency_{}".format(concurrency),
+                {"concurrency": concurrency, "clips": args.clips,
+                 "stub_delay": args.stub_delay},
+                {"seconds": elapsed,
+                 "clips_per_second": args.clips / elapsed,
+                 "p50_ms": percentile(latencies_ms, 0.50),
+                 "p95_ms": percentile(latencies_ms, 0.95),
+                 "max_ms": max(latencies_ms) if latencies_ms else 0.0,
+                 "reuse_rate": pool.reuse_rate(),
+                 "failed": failed}))
+    finally:
+        server.close()
+    return results
@@ -0,0 +1,83 @@
+"""
+Benchmark reading and compiling the text/control file.
+
+Synthetic control files of increasing size are written to a temporary
+folder, then timed through read_text_file() and compile_control().
+"""
+import os
+import time
+import tempfile
+
+from common import presenter, repo_dir, result
+
+music_file = os.path.join(repo_dir, "espeak_1.wav")
+
+
+def make_control_lines(line_count, max_slide=18):
+    """
+    Return line_count lines of a control file using every command, with
+    comments and paragraphs spanning two lines.
+    """
+    lines = ["# Synthetic control file for benchmarking.",
+             "[slide_show_file:google_talk_presentation.odp]", ""]
+    slide = 0
+    while len(lines) < line_count:
+        slide += 1
+        lines.append("[slide:{}]".format(slide % max_slide + 1))
+        if slide % 5 == 0:
+            lines.append("[language:french]")
+            lines.append("Bonjour le monde, diapositive {}.".format(slide))
+        else:
+            lines.append("[language:english]")
+            lines.append("This is the commentary for slide {}, which runs"
+                         .format(slide))
+            lines.append("on to a second line of the same paragraph.")
+        lines.append("")
+        lines.append("# A comment line.")
+        lines.append("[pause:0.5]")
+        if slide % 10 == 0:
+            lines.append("[music:{}]".format(music_file))
+        lines.append("Another short paragraph.")
+        lines.append("")
+    return lines[:line_count]
+
+
+def run(args):
+    """Time the parse of each size of file. Return the results."""
+    results = []
+    folder = tempfile.mkdtemp(prefix="bench_parse_")
+    try:
+        for line_count in args.sizes:
+            path = os.path.join(folder, "control_{}.txt".format(line_count))
+            with open(path, "w") as f:
+                f.write("\n".join(make_control_lines(line_count)))
+                f.write("\n")
+
+            read_times = []
+            compile_times = []
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                lines = presenter.read_text_file(path)
+                middle = time.perf_counter()
+                control_dict, totals, errors = presenter.compile_control(
+                        lines, 18, presenter.language_code_dict)
+                end = time.perf_counter()
+                if errors:
+                    raise RuntimeError("Synthetic control file has errors: "
+                                       "{}".format(errors[:3]))
+                read_times.append(middle - start)
+                compile_times.append(end - middle)
+
+            best = min(r + c for r, c in zip(read_times, compile_times))
+            results.append(result(
+                "parse", "parse_{}_lines".format(line_count),
+                {"lines": line_count, "repeat": args.repeat},
+                {"seconds": best,
+                 "read_seconds": min(read_times),
+                 "compile_seconds": min(compile_times),
+                 "lines_per_second": line_count / best if best else 0.0,
+                 "slides": totals["slide"]}))
+            os.remove(path)
+    finally:
+        os.rmdir(folder)
+    return results
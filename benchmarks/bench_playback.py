@@ -0,0 +1,106 @@
+"""
+Benchmark the playback of a show: the gap between back-to-back clips and
+the latency of a slide change.
+
+main() runs a synthetic show against a fake Impress controller. Audio goes
+to a fakesink that consumes it in real time. Each slide has a music clip,
+a paragraph of speech from the local stub server and a second music clip.
+The slide change latency is from the end of the audio before a [slide:]
+command to the start of the audio after it.
+"""
+import os
+import time
+import shutil
+import tempfile
+
+from common import StubServer, percentile, presenter, repo_dir, result
+
+Gst = presenter.Gst
+
+
+class FakeController:
+    """
+    Stands in for the Impress slide show controller. Each slide change
+    takes delay seconds, like a round trip over the UNO bridge.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.slide_times = []
+
+    def gotoSlideIndex(self, index):
+        time.sleep(self.delay)
+        self.slide_times.append(time.monotonic())
+
+
+class TimedEngine(presenter.PlaybackEngine):
+    """PlaybackEngine that records the time of each clip start and EOS."""
+    def __init__(self, *args, **kwargs):
+        presenter.PlaybackEngine.__init__(self, *args, **kwargs)
+        self.stream_starts = []
+        self.eos_times = []
+
+    def bus_call(self, bus, message):
+        if message.type == Gst.MessageType.STREAM_START:
+            self.stream_starts.append(time.monotonic())
+        elif message.type == Gst.MessageType.EOS:
+            self.eos_times.append(time.monotonic())
+        return presenter.PlaybackEngine.bus_call(self, bus, message)
+
+
+def slide_change_latencies(slide_times, eos_times, stream_starts):
+    """
+    For each slide change after the first, return the milliseconds from the
+    last EOS before it to the first clip start after it.
+    """
+    latencies = []
+    for slide_time in slide_times[1:]:
+        before = [t for t in eos_times if t <= slide_time]
+        after = [t for t in stream_starts if t >= slide_time]
+        if before and after:
+            latencies.append((after[0] - before[-1]) * 1000)
+    return latencies
+
+
+def run(args):
+    """Play args.slides slides and measure the gaps."""
+    with open(os.path.join(repo_dir, "pico_2.wav"), "rb") as f:
+        body = f.read()
+    server = StubServer(body, args.stub_delay)
+    folder = tempfile.mkdtemp(prefix="bench_playback_")
+    try:
+        cache = presenter.AudioCache(folder, 1 << 30)
+        backend = presenter.HTTPBackend(server.url)
+        control_dict = {}
+        for i in range(args.slides):
+            control_dict[i] = [
+                ["slide", i % 18 + 1, 0],
+                ["music", os.path.join(repo_dir, "espeak_1.wav"), 0],
+                ["en", "Narration for slide {}.".format(i + 1), 0],
+                ["music", os.path.join(repo_dir, "pico_1.wav"), 0]]
+        controller = FakeController(args.uno_delay)
+        engine = TimedEngine("fakesink")
+        start = time.perf_counter()
+        presenter.main(control_dict, None, controller, "mplayer", 0, cache,
+                       presenter.prefetch_depth, backend, engine)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.close()
+        shutil.rmtree(folder)
+
+    slide_ms = slide_change_latencies(controller.slide_times,
+                                      engine.eos_times, engine.stream_starts)
+    return [result(
+        "playback", "playback_{}_slides".format(args.slides),
+        {"slides": args.slides, "uno_delay": args.uno_delay,
+         "stub_delay": args.stub_delay},
+        {"seconds": elapsed,
+         "gap_mean_ms": (sum(engine.gaps) / len(engine.gaps)
+                         if engine.gaps else 0.0),
+         "gap_p95_ms": percentile(engine.gaps, 0.95),
+         "gap_max_ms": max(engine.gaps) if engine.gaps else 0.0,
+         "start_delay_mean_ms": (sum(engine.start_delays) /
+                                 len(engine.start_delays)
+                                 if engine.start_delays else 0.0),
+         "slide_change_mean_ms": (sum(slide_ms) / len(slide_ms)
+                                  if slide_ms else 0.0),
+         "slide_change_max_ms": max(slide_ms) if slide_ms else 0.0})]
@@ -0,0 +1,78 @@
+"""
+Shared helpers for the benchmarks of google_talk_presenter.py.
+
+Puts the repository folder on the import path, so the benchmarks can be run
+from any folder, and provides the result records, a percentile function and
+a local http server standing in for google text to speech.
+"""
+import os
+import sys
+import time
+import threading
+import http.server
+import socketserver
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+
+import google_talk_presenter as presenter
+
+
+def result(group, name, params, metrics):
+    """Return one benchmark result record."""
+    return {"group": group, "name": name, "params": params,
+            "metrics": metrics}
+
+
+def percentile(values, fraction):
+    """Return the value at the fraction (0 to 1) of the sorted values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class StubServer:
+    """
+    Local http server standing in for the text to speech endpoint. Every
+    request is answered with the same audio data after delay seconds.
+    Connections are kept alive, like google's.
+    url has the {language} and {text} fields used by HTTPBackend.
+    """
+    def __init__(self, body, delay=0.0):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(stub.delay)
+                self.send_response(200)
+                self.send_header("Content-Type", "audio/mpeg")
+                self.send_header("Content-Length", str(len(stub.body)))
+                self.end_headers()
+                self.wfile.write(stub.body)
+                stub.requests += 1
+
+            def log_message(self, *args):
+                pass
+
+        self.body = body
+        self.delay = delay
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = ("http://127.0.0.1:{}/translate_tts?tl={{language}}"
+                    "&q={{text}}".format(self.server.server_port))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
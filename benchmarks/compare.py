@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Compare two benchmark result files written by run_benchmarks.py.
+
+Prints the change of every metric found in both files and exits with status
+1 if any metric is worse by more than the threshold. Metrics named *_ms or
+*seconds are better lower, *_per_second and reuse_rate are better higher.
+Other metrics are shown but not judged.
+
+Usage:
+  $ python3 benchmarks/compare.py baseline.json bench_output.json
+"""
+import sys
+import json
+import argparse
+
+
+def direction(metric):
+    """Return -1 if lower is better, 1 if higher is better, else 0."""
+    if metric.endswith("_per_second") or metric == "reuse_rate":
+        return 1
+    if metric.endswith("_ms") or metric.endswith("seconds"):
+        return -1
+    return 0
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return {(r["group"], r["name"]): r["metrics"] for r in report["results"]}
+
+
+def compare(baseline, current, threshold):
+    """Print the changes. Return the number of regressions."""
+    regressions = 0
+    for key in sorted(set(baseline) & set(current)):
+        for metric in sorted(set(baseline[key]) & set(current[key])):
+            old = baseline[key][metric]
+            new = current[key][metric]
+            if old:
+                change = (new - old) / abs(old)
+            else:
+                change = 0.0
+            worse = -change * direction(metric) > threshold
+            if worse:
+                regressions += 1
+            print("{:8} {:28} {:22} {:12.4g} {:12.4g} {:+7.1%}{}".format(
+                key[0], key[1], metric, old, new, change,
+                "  REGRESSION" if worse else ""))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="fractional change counted as a regression "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+    regressions = compare(load(args.baseline), load(args.current),
+                          args.threshold)
+    print("{} regression(s)".format(regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Run the benchmarks of google_talk_presenter.py and write the results as
+JSON, for comparison between runs with compare.py.
+
+Groups:
+  parse     read_text_file() and compile_control() on synthetic control
+            files from 100 to 100,000 lines.
+  fetch     speech fetched from a local stub server through the prefetcher
+            at varying concurrency.
+  playback  inter-clip gap and slide change latency of main(), using a
+            fakesink and a fake Impress controller.
+
+Usage:
+  $ python3 benchmarks/run_benchmarks.py --output bench_output.json
+  $ python3 benchmarks/run_benchmarks.py --groups parse --sizes 100 1000
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+from common import repo_dir
+
+groups = ["parse", "fetch", "playback"]
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Benchmark google_talk_presenter.py")
+    parser.add_argument("--groups", nargs="+", choices=groups,
+                        default=groups, help="benchmark groups to run")
+    parser.add_argument("--output", default="bench_output.json",
+                        help="JSON results file, - for standard output "
+                             "(default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="parse: runs of each size, the best is kept")
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        default=[100, 1000, 10000, 100000],
+                        help="parse: control file sizes in lines")
+    parser.add_argument("--concurrency", nargs="+", type=int,
+                        default=[1, 2, 4, 8, 16],
+                        help="fetch: concurrency levels")
+    parser.add_argument("--clips", type=int, default=64,
+                        help="fetch: paragraphs fetched at each level")
+    parser.add_argument("--stub-delay", type=float, default=0.05,
+                        help="fetch, playback: stub server response delay "
+                             "in seconds")
+    parser.add_argument("--slides", type=int, default=4,
+                        help="playback: slides in the synthetic show")
+    parser.add_argument("--uno-delay", type=float, default=0.005,
+                        help="playback: seconds taken by each fake slide "
+                             "change")
+    return parser.parse_args(argv)
+
+
+def git_commit():
+    """Return the commit of the repository, or None."""
+    try:
+        return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=repo_dir,
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    results = []
+    for group in args.groups:
+        module = __import__("bench_{}".format(group))
+        sys.stderr.write("Running {} benchmarks...\n".format(group))
+        results.extend(module.run(args))
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "commit": git_commit(),
+                       "python": platform.python_version(),
+                       "platform": platform.platform()},
+              "results": results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        sys.stderr.write("Results written to {}\n".format(args.output))
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -14,7 +14,6 @@
 # Presented at Hamilton Pytohn User Group meeting Monday, 8 May 2017
 #
 # TODO: Check program on Windows platform !
-# TODO: Add sys.argv commands
 #
 # PREREQUISITES:
 # 1. Ensure you have python3 installed.
@@ -38,15 +37,32 @@
 # Importing...
 import os
 import sys
+import re
+import json
 import time
+import random
+import mmap
+import struct
+import hashlib
+import unicodedata
+import tempfile
+import queue
+import threading
 import subprocess
+import http.client
+import argparse
+import asyncio
+import contextlib
+import collections
+import concurrent.futures
 import urllib.parse
 import urllib.request
 
 
 import gi
 gi.require_version('Gst', '1.0')
-from gi.repository import GObject, Gst
+gi.require_version('GstPbutils', '1.0')
+from gi.repository import GLib, GObject, Gst, GstPbutils
 
 
 try: 
@@ -54,6 +70,7 @@ try:
 except ImportError:
     sys.exit("ImportError:\nInstall uno: sudo apt-get install python3-uno")
 import unohelper
+from com.sun.star.connection import NoConnectException
 
 # initialize variables
 text_file = "google_talk_presentation.txt"
@@ -65,6 +82,123 @@ default_language = "English"
 default_language_code = "en"
 slide_start = 0
 
+# Seconds to wait for LibreOffice to accept the connection, and for the
+# slide show to start running.
+office_timeout = 60
+presentation_timeout = 30
+
+# Connection to LibreOffice, as given to soffice --accept and to the UNO url
+# resolver. A pipe is faster than a socket when on the same machine, e.g.
+# "pipe,name=google_talk". Set with --office-pipe, --office-host and
+# --office-port, or --office-connection.
+office_host = "localhost"
+office_port = 2002
+office_connection = "socket,host=localhost,port=2002"
+
+# On-disk cache of the speech returned by google. Folder is relative to the
+# current working directory. Least recently used clips are removed once the
+# total size exceeds cache_max_bytes.
+cache_dir = "tts_cache"
+cache_max_bytes = 200 * 1024 * 1024
+audio_cache = None
+
+# Music files are decoded once to raw audio in pcm_cache_dir and played
+# from memory mapped buffers. Least recently used files are removed once
+# the total size exceeds pcm_max_bytes.
+pcm_cache_dir = "pcm_cache"
+pcm_max_bytes = 512 * 1024 * 1024
+pcm_caps = "audio/x-raw,format=S16LE,layout=interleaved,rate=44100,channels=2"
+pcm_bytes_per_second = 44100 * 2 * 2
+music_cache = None
+
+# Packed archive of all the audio of a show, from --export-archive. Opened
+# with --archive and looked up before the caches.
+archive_magic = b"GTPACK\0\0"
+archive_version = 1
+# magic, version, entry count
+archive_header = struct.Struct("<8sII")
+# id, offset, length, codec, duration in seconds. Sorted by id.
+archive_entry = struct.Struct("<32sQQ8sd")
+audio_archive = None
+
+# Text to speech backend: google, espeak, pico or http. The http backend
+# sends requests to http_backend_url, e.g. a local stand-in server. The
+# {language} and {text} fields are filled in url encoded.
+tts_backend = "google"
+http_backend_url = "http://localhost:8000/translate_tts?tl={language}&q={text}"
+audio_backend = None
+
+# Keep-alive http connections used to fetch the speech. Up to http_pool_size
+# connections per host, each used for up to http_max_requests requests.
+http_pool_size = 4
+http_timeout = 10
+http_max_requests = 100
+
+# With --stream-speech, speech not in the cache is played as it arrives.
+# Up to speech_buffer_chunks chunks of speech_chunk_bytes are held between
+# the download and the player. A clip whose buffer stays full for 
+# speech_stall_timeout seconds, e.g. one fetched ahead, is downloaded to
+# the cache in full and played from there.
+speech_streaming = False
+speech_chunk_bytes = 16 * 1024
+speech_buffer_chunks = 8
+speech_stall_timeout = 5
+
+# A request for speech from google or the http backend has fetch_deadline
+# seconds to succeed. A failed request is retried up to fetch_retries times
+# after a random backoff of up to retry_backoff seconds, doubling each
+# time to at most retry_backoff_max. A request with no answer after the 
+# 95th percentile of the recent latencies is hedged with a second one, and
+# the first answer used. Until hedge_min_samples latencies have been seen
+# hedge_delay seconds is used.
+fetch_deadline = 8
+fetch_retries = 3
+retry_backoff = 0.25
+retry_backoff_max = 2
+hedge_delay = 1.0
+hedge_min_samples = 20
+hedge_window = 200
+
+# Limits on the requests sent to each network backend, shared by all the
+# fetching. A token bucket allows rate requests per second, in bursts of
+# up to burst. The requests in flight start at concurrency. The limit 
+# grows by one for each round of answers within target_latency seconds,
+# and halves when the server throttles (HTTP 429 or 503) or is slower,
+# staying between 1 and max_concurrency. Set with --fetch-rate and 
+# --fetch-concurrency. More than http_pool_size requests in flight need a 
+# larger --http-pool-size.
+fetch_limits = {
+    "google": {"rate": 5, "burst": 5, "concurrency": 2,
+               "max_concurrency": 4, "target_latency": 2.0},
+    "http": {"rate": 200, "burst": 50, "concurrency": 4,
+             "max_concurrency": 8, "target_latency": 1.0},
+}
+
+# Local engine that speaks a paragraph when the deadline passes, so the 
+# show does not go silent. espeak, pico or None.
+fallback_engine = "espeak"
+
+# Number of paragraphs of speech fetched ahead of the one playing, and the
+# number of worker threads fetching them.
+prefetch_depth = 3
+prefetch_workers = 4
+
+# With --stream, the most slide blocks parsed ahead of the one presenting.
+stream_window = 8
+
+# With --watch, seconds between checks of the control file for changes.
+watch_interval = 0.5
+
+# With --asyncio, seconds before the audio ends that the next slide change
+# is sent, until the round trip to LibreOffice has been measured.
+slide_lead = 0.1
+
+# Longest text sent to google in one request. Longer paragraphs are split
+# at sentence, then clause, then word boundaries.
+tts_char_limit = 200
+# Languages written without spaces between words.
+unspaced_languages = ("zh-CN", "zh-TW", "ja", "th", "km")
+
 # Languages that google can perform text to speech as of 2017-03-30
 language_code_dict = {
 'albanian': 'sq', 'arabic': 'ar', 'armenian': 'hy', 'basque': 'eu', 
@@ -92,621 +226,4402 @@ if sys.version_info.major < 3:
 #------------------------------------------------------------------------------
 #   Main procedural controlling function
 #------------------------------------------------------------------------------
-def main(control_dict, oDoc, oControl, mp3_player, slide_start=0):
+def main(control_dict, oDoc, oControl, mp3_player, slide_start=0,
+         cache=None, depth=prefetch_depth, backend=None, engine=None,
+         interactive=False, asynchronous=False, timeline=None):
     """
     Main function to control the flow of the program.
     The control_dict is a dictionary with keys from 0 to the number of 
     slides -1 to display.
     The value for each key is a list.
-    Each list is a series of lists that comprize of a key and a value.
+    Each list is a series of lists that comprize of a key, a value and the
+    line number in the text/control file.
     Calls text_to_speech() and time.sleep() function
     Sends commands through pyuno bridge to Impress presentation
 
-    Call the initialization and return player and loop
-    For each item in the audio list call play_audio.
+    Create the playback engine, unless one is passed in.
+    Consecutive music and text items are handed to the engine as one run
+    so they are played back-to-back. A slide or pause command ends the run.
+    Speech is taken from the audio cache, only cache misses go to the text
+    to speech backend.
+    The speech for the next depth paragraphs is fetched while the current
+    paragraph is playing.
+    If interactive, the show is controlled from the keyboard as well. A 
+    seek moves the live plan and the show reads on from the new position.
+    If asynchronous, the show is run by the AsyncScheduler instead.
+    With a timeline, the show keeps to its planned times and the drift is 
+    reported.
+    """
+    if cache is None:
+        cache = audio_cache
+    if backend is None:
+        backend = audio_backend
+    if engine is None:
+        engine = PlaybackEngine()
+    prefetcher = Prefetcher(cache, depth, backend=backend,
+                            streaming=speech_streaming)
+    if interactive and not isinstance(control_dict, LivePlan):
+        control_dict = LivePlan(control_dict)
+    if isinstance(control_dict, LivePlan):
+        seek_event = control_dict.seek_event
+    else:
+        seek_event = threading.Event()
+    # Slide changes are made on a thread of their own.
+    dispatcher = SlideDispatcher(oControl)
+    # The item being presented, for the keyboard controls and the reloads
+    # of the live plan.
+    if isinstance(control_dict, LivePlan):
+        current = control_dict.current
+    else:
+        current = [None]
+    if interactive:
+        keyboard = KeyboardControl(control_dict, engine, prefetcher)
+
+    try:
+        playlist = iter_playlist(control_dict, slide_start)
+        stream = prefetcher.iterate(playlist)
+        if asynchronous:
+            scheduler = AsyncScheduler(dispatcher, engine, timeline=timeline)
+            scheduler.run(stream)
+            print(scheduler.report())
+        else:
+            present(control_dict, dispatcher, engine, stream, seek_event, 
+                    current, prefetcher, timeline)
+    finally:
+        dispatcher.stop()
+        prefetcher.shutdown()
+        engine.close()
+    #oDoc.Presentation.dispose()
+    print("Audio cache: {} hits, {} misses"
+          .format(cache.hits, cache.misses))
+    print(engine.gap_report())
+    if engine.seek_latencies:
+        print(engine.seek_report())
+    if engine.stream_latencies:
+        print(engine.stream_report())
+    if engine.retried or engine.skipped:
+        print(engine.error_report())
+    if timeline is not None:
+        timeline.finish()
+        print(timeline.report())
+    print(dispatcher.report())
+    if backend.report():
+        print(backend.report())
+
+
+def present(control_dict, dispatcher, engine, stream, seek_event, current,
+            prefetcher, timeline=None):
+    """
+    Present the items of the stream, one at a time. Slide changes are sent
+    to Impress by the dispatcher, pauses wait and runs of audio items are 
+    played by the engine, blocking until each is done. A pause or audio
+    waits for the slide change before it to be made.
+    When a run of audio is followed by a slide change, the change is sent
+    as the last clip is queued, held by the dispatcher until the clip is
+    due to end less the round trip time.
+    When the seek_event is set the stream is read again from the position
+    of the live plan.
+    With a timeline, slide blocks wait for their planned start and pauses
+    end at their planned time.
+    """
+    # Holds an item read ahead by audio_run() that was not audio.
+    pushback = []
+    # The slide change being made, and one sent ahead of its item.
+    slide_future = None
+    early = []
+
+    def send_early():
+        # Called from the streaming thread as the last clip is queued.
+        if pushback and pushback[-1][0][0] == "slide":
+            next_item = pushback[-1][0]
+            if timeline is not None and timeline.delay(next_item) > 0:
+                return
+            at = (time.monotonic() + engine.remaining() - dispatcher.lead())
+            early.append((next_item, 
+                          dispatcher.goto_slide(next_item[1]-1, at=at)))
+
+    while True:
+        if seek_event.is_set():
+            # Moved by a keyboard command, or the plan was reloaded. Read
+            # on from the new position, dropping the items read ahead.
+            seek_event.clear()
+            pushback = []
+            stream = prefetcher.iterate(iter_playlist(control_dict))
+        if pushback:
+            item, future = pushback.pop()
+        else:
+            try:
+                item, future = next(stream)
+            except StopIteration:
+                break
+        #print(item[0])
+        key = item[0]
+        #print(item[1])
+        value = item[1]
+        current[0] = item
+        if timeline is not None:
+            time.sleep(timeline.delay(item))
+            timeline.reached(item)
+
+        if key == "slide":
+            # Change slide
+            #print("Changing to next slide: {}".format(value-1))
+            if early and early[-1][0] is item:
+                slide_future = early.pop()[1]
+            else:
+                slide_future = dispatcher.goto_slide(value-1)
+            del early[:]
+            continue
+
+        if slide_future is not None and (key == "pause" or 
+                                         key == "music" or 
+                                         future is not None):
+            slide_future.result()
+            slide_future = None
+
+        if key == "pause":   
+            if timeline is not None:
+                value = timeline.pause_time(item)
+            with tracer.span("pause", "show", seconds=value):
+                # A seek cuts the pause short.
+                seek_event.wait(value)
+            continue
+
+        if key == "music" or future is not None:
+            # Value is a mp3 file name, or key = language and value is a
+            # paragraph of text. Play it and any audio items following.
+            engine.play(notify_end(audio_run(item, future, stream, 
+                                             pushback, current), 
+                                   send_early))
+            continue
+    if slide_future is not None:
+        slide_future.result()
+
+
+def audio_run(item, future, stream, pushback, current=None):
+    """
+    Yield the audio files for an audio item and for the audio items that
+    directly follow it in the stream. Music items yield the file name, text
+    items yield the file of each chunk as its prefetch completes. Chunks that
+    failed to be fetched are skipped.
+    The first item that is not audio is put on the pushback list and the 
+    run ends.
+    The item being played is kept in current[0], if current is given.
     """
-    player, loop = initialize()
+    while True:
+        if current is not None:
+            current[0] = item
+        if item[0] == "music":
+            tracer.instant("music", "show", source=item[1])
+            yield music_source(item[1])
+        else:
+            for chunk_future in future:
+                audio_file = chunk_future.result()
+                if audio_file is not None:
+                    yield audio_file
+        try:
+            item, future = next(stream)
+        except StopIteration:
+            return
+        if item[0] != "music" and future is None:
+            pushback.append((item, future))
+            return
 
-    for i in range(slide_start, len(control_dict)):
-        slide_list = control_dict[i]
+
+def iter_playlist(control_dict, slide_start=0):
+    """
+    Yield the [key, value, line number] items of the control_dict in the
+    order they are to be presented, starting at the slide_start key.
+    Instead of a dictionary, control_dict may be an iterable of (index, 
+    slide_list) such as a BlockStream, which is read as the show goes.
+    """
+    if isinstance(control_dict, dict):
+        blocks = ((i, control_dict[i]) 
+                  for i in range(slide_start, len(control_dict)))
+    else:
+        blocks = control_dict
+    for index, slide_list in blocks:
+        if index < slide_start:
+            continue
         for item in slide_list:
-            if len(item) == 2:
-                #print(item[0])
-                key = item[0]
-                #print(item[1])
-                value = item[1]
-
-                if key == "slide":
-                    # Change slide
-                    #print("Changing to next slide: {}".format(value-1))
-                    oControl.gotoSlideIndex(value-1)
-                    continue
+            yield item
+
+
+def is_text_item(key):
+    """
+    Return True if the key of a control item is a language code, meaning
+    the value is a paragraph of text to be spoken.
+    Two chinese languages have 5 x characters. 
+    """
+    return len(key) == 2 or key == "zh-TW" or key == "zh-CN"
+
+
+class Prefetcher:
+    """
+    Fetch the speech for upcoming paragraphs while the current one plays.
+    Walks the playlist ahead of the playback cursor and submits up to 
+    depth text items to a bounded pool of worker threads. Playback then
+    reads the finished audio files from the cache. If streaming, speech
+    not in the cache is played as it arrives.
+    """
+    def __init__(self, cache, depth=prefetch_depth, workers=prefetch_workers,
+                 backend=None, streaming=False):
+        """
+        The number of worker threads is limited to the concurrency the
+        backend declares.
+        """
+        if backend is None:
+            backend = audio_backend
+        self.cache = cache
+        self.backend = backend
+        self.depth = depth
+        self.streaming = streaming
+        workers = min(workers, backend.max_concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, workers))
+
+    def submit(self, item):
+        """
+        Start fetching the speech for a text item. Long paragraphs are split
+        into chunks which are fetched in parallel. Return the list of 
+        futures, one per chunk, whose results are the audio file paths.
+        Return None if the item is not text.
+        """
+        key, value = item[0], item[1]
+        if not is_text_item(key):
+            return None
+        return [self.executor.submit(speech_file, chunk, key, self.cache,
+                                     self.backend, self.streaming)
+                for chunk in split_text(value, key)]
+
+    def iterate(self, playlist):
+        """
+        Yield (item, futures) for each item in the playlist. Before an item
+        is yielded, the speech for the following depth text items has been
+        submitted for fetching.
+        """
+        playlist = iter(playlist)
+        pending = collections.deque()
+        fetching = 0
+        exhausted = False
+        while True:
+            # Keep the current text item plus depth more in flight.
+            while not exhausted and fetching <= self.depth:
+                try:
+                    item = next(playlist)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = self.submit(item)
+                if future is not None:
+                    fetching += 1
+                pending.append((item, future))
+            if not pending:
+                return
+            item, future = pending.popleft()
+            if future is not None:
+                fetching -= 1
+            yield item, future
+
+    def shutdown(self, wait=False):
+        """
+        Stop the worker threads. If wait is True, wait for the fetches 
+        already submitted to complete.
+        """
+        self.executor.shutdown(wait=wait)
 
-                if key == "pause":   
-                    time.sleep(value)
-                    continue
 
-                if key == "music":
-                    # Value is a mp3 file name                     
-                    #print("Music:", value)    
-                    play_audio(value, player, loop)                    
-
-                if len(key) == 2:
-                    # key = language, value = paragraph of text. 
-                    #text_to_speech(value, key, mp3_player)
-
-                    #for message in message_list:
-                    #if ".mp3" in message:
-                    # pass the mp3 filename
-                    #arg_list.append(message)
-                    #else:
-                    # Create the uri for google  
-                    s = 'https://translate.google.com/translate_tts?'
-                    s = s + 'ie=UTF-8&client=tw-ob&tl={}&q={}'
-                    audio_string = s.format(key,value)
-                    #print(audio_string, len(audio_string)-73)
-                    play_audio(audio_string, player, loop) 
+#------------------------------------------------------------------------------
+#   Slide dispatcher
+#------------------------------------------------------------------------------
+class SlideDispatcher:
+    """
+    Makes the calls to the slide show controller on a thread of its own, 
+    in the order they are made, so playback does not wait on LibreOffice.
+    Each call returns a concurrent.futures.Future of its result. A call may
+    be held until a given time.monotonic(), e.g. to change the slide just
+    as the audio ends. The round trip of each call is measured.
+    """
+    def __init__(self, oControl, lead=slide_lead):
+        self.oControl = oControl
+        self.default_lead = lead
+        self.calls = queue.Queue()
+        # Round trip times of the calls by method name, in milliseconds.
+        self.round_trips = collections.defaultdict(list)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def call(self, name, *args, at=None):
+        """Queue a call of the named controller method. Return a future."""
+        future = concurrent.futures.Future()
+        self.calls.put((future, at, name, args))
+        return future
+
+    def goto_slide(self, index, at=None):
+        return self.call("gotoSlideIndex", index, at=at)
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            future, at, name, args = call
+            if at is not None:
+                delay = at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.monotonic()
+            try:
+                result = getattr(self.oControl, name)(*args)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            end = time.monotonic()
+            self.round_trips[name].append((end - start) * 1000)
+            tracer.complete(name, "uno", start, end, args=list(args))
+            future.set_result(result)
+
+    def lead(self):
+        """Return the mean round trip of a slide change, in seconds."""
+        round_trips = self.round_trips["gotoSlideIndex"]
+        if not round_trips:
+            return self.default_lead
+        return sum(round_trips) / len(round_trips) / 1000
+
+    def stop(self):
+        """Stop the thread once the calls queued are made."""
+        self.calls.put(None)
+        self.thread.join()
+
+    def report(self):
+        """Return a line of the round trip times of each kind of call."""
+        parts = []
+        for name in sorted(self.round_trips):
+            values = self.round_trips[name]
+            if values:
+                parts.append("{} {} calls, mean {:.1f} ms, max {:.1f} ms"
+                             .format(name, len(values), 
+                                     sum(values) / len(values), max(values)))
+        if not parts:
+            return "UNO calls: none."
+        return "UNO calls: {}.".format("; ".join(parts))
+
+
+#------------------------------------------------------------------------------
+#   Asyncio scheduler
+#------------------------------------------------------------------------------
+def resolve(future, result=None):
+    """Set the result of an asyncio future, unless it is already done."""
+    if not future.done():
+        future.set_result(result)
+
+
+def notify_end(sources, callback):
+    """Yield the sources, then call the callback."""
+    for source in sources:
+        yield source
+    callback()
+
+
+class MainLoopThread:
+    """
+    Run a GLib main loop in a thread of its own, to deliver the bus 
+    messages of engines that are driven from asyncio.
+    """
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = GObject.MainLoop()
+        self.loop = loop
+        self.thread = threading.Thread(target=self.loop.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.loop.quit()
+        self.thread.join(1)
+
+
+class AsyncScheduler:
+    """
+    Present the show from an asyncio event loop, so slide changes, fetches
+    and playback overlap instead of each blocking in turn.
+    The GLib main loop of the engine runs in its own thread and the end of
+    each run of audio is awaited. Calls to Impress are made by the 
+    SlideDispatcher, which keeps them in order.
+    A slide change is sent as soon as it is read. The audio that follows 
+    waits for both the slide change and its first chunk of speech.
+    When the last clip of a run is playing and the next item is a slide
+    change, the change is sent ahead of the end of the clip by the 
+    measured round trip time, so the slide appears as the audio ends.
+    With a timeline, slide blocks wait for their planned start and pauses
+    end at their planned time.
+    """
+    def __init__(self, dispatcher, engine, lead=slide_lead, timeline=None):
+        self.dispatcher = dispatcher
+        self.engine = engine
+        self.timeline = timeline
+        self.default_lead = lead
+        # Slide change round trip times, and the waits for the slide and 
+        # speech to be ready before audio is played. In milliseconds.
+        self.round_trips = []
+        self.ready_waits = []
+        self.early_changes = 0
+
+    def run(self, stream):
+        """Present the items of the stream and return when done."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.engine.start_loop_thread()
+        try:
+            loop.run_until_complete(self.present(stream))
+        finally:
+            self.engine.stop_loop_thread()
+            loop.close()
+
+    def lead(self):
+        """Return the seconds to send a slide change ahead of the audio."""
+        if not self.round_trips:
+            return self.default_lead
+        return sum(self.round_trips) / len(self.round_trips) / 1000
+
+    async def goto_slide(self, value):
+        start = time.monotonic()
+        await asyncio.wrap_future(self.dispatcher.goto_slide(value-1))
+        end = time.monotonic()
+        self.round_trips.append((end - start) * 1000)
+        tracer.complete("slide change", "uno", start, end, slide=value)
+
+    async def present(self, stream):
+        loop = asyncio.get_event_loop()
+        # Holds an item read ahead by audio_run() that was not audio.
+        pushback = []
+        # The slide change not yet awaited, and one sent ahead of its item.
+        slide_task = None
+        early = None
+        while True:
+            if pushback:
+                item, future = pushback.pop()
+            else:
+                try:
+                    item, future = next(stream)
+                except StopIteration:
+                    break
+            key = item[0]
+            value = item[1]
+            if self.timeline is not None:
+                await asyncio.sleep(self.timeline.delay(item))
+                self.timeline.reached(item)
+
+            if key == "slide":
+                if slide_task is not None:
+                    await slide_task
+                if early is not None and early[0] is item:
+                    slide_task = early[1]
+                else:
+                    slide_task = asyncio.ensure_future(self.goto_slide(value))
+                early = None
+                continue
+
+            # Wait for the slide to show, and the first of the speech.
+            ready = []
+            if slide_task is not None:
+                ready.append(slide_task)
+                slide_task = None
+            if future:
+                ready.append(asyncio.wrap_future(future[0]))
+            if ready:
+                start = time.monotonic()
+                await asyncio.gather(*ready)
+                self.ready_waits.append((time.monotonic() - start) * 1000)
+
+            if key == "pause":
+                if self.timeline is not None:
+                    value = self.timeline.pause_time(item)
+                with tracer.span("pause", "show", seconds=value):
+                    await asyncio.sleep(value)
+                continue
+
+            if key == "music" or future is not None:
+                ending = loop.create_future()
+                sources = notify_end(
+                        audio_run(item, future, stream, pushback),
+                        lambda: loop.call_soon_threadsafe(resolve, ending))
+                done = self.engine.play_async(sources)
+                if done is None:
                     continue
+                await asyncio.wait([ending, done], 
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if (not done.done() and pushback and 
+                        pushback[-1][0][0] == "slide" and 
+                        (self.timeline is None or 
+                         self.timeline.delay(pushback[-1][0]) == 0)):
+                    # The last clip is playing. Send the next slide change
+                    # to arrive as it ends.
+                    delay = self.engine.remaining() - self.lead()
+                    if delay > 0:
+                        await asyncio.wait([done], timeout=delay)
+                    if not done.done():
+                        next_item = pushback[-1][0]
+                        early = (next_item, asyncio.ensure_future(
+                                self.goto_slide(next_item[1])))
+                        self.early_changes += 1
+                await done
+                self.engine.finish()
+        if slide_task is not None:
+            await slide_task
+
+    def report(self):
+        """Return a line summarizing the slide changes."""
+        if not self.round_trips:
+            return "Slide changes: none."
+        return ("Slide changes: {}, mean round trip {:.1f} ms, {} sent ahead "
+                "of the audio ending.".format(
+                        len(self.round_trips),
+                        sum(self.round_trips) / len(self.round_trips),
+                        self.early_changes))
+
+
+#------------------------------------------------------------------------------
+#   Fleet mode
+#------------------------------------------------------------------------------
+def load_fleet(fleet_file):
+    """
+    Read the fleet file, a JSON list with an object for each show. E.g.
+        [{"control": "lobby.txt", "audio_sink": "alsasink device=hw:1",
+          "impress": true, "slide_start": 0},
+         {"control": "cafe.txt"}]
+    Only control is required. Files are relative to the working folder.
+    Without impress, the show runs with a NullController.
+    Return the list of shows with the defaults filled in. Exits on errors.
+    """
+    try:
+        with open(fleet_file) as f:
+            shows = json.load(f)
+    except (OSError, ValueError) as e:
+        print("Unable to read fleet file {}: {}".format(fleet_file, e))
+        sys.exit("Exiting...")
+    if not isinstance(shows, list) or not shows:
+        print("Fleet file {} must be a list of shows.".format(fleet_file))
+        sys.exit("Exiting...")
+    for number, show in enumerate(shows, 1):
+        if not isinstance(show, dict) or "control" not in show:
+            print("Show {} of {} has no control file.".format(number, 
+                                                               fleet_file))
+            sys.exit("Exiting...")
+        show["control"] = os.path.abspath(show["control"])
+        show.setdefault("audio_sink", None)
+        show.setdefault("impress", False)
+        show.setdefault("slide_start", 0)
+    return shows
+
+
+class NullController:
+    """
+    Stands in for the Impress slide show controller of a headless show.
+    Records the slides shown.
+    """
+    def __init__(self):
+        self.slides = []
+
+    def gotoSlideIndex(self, index):
+        self.slides.append(index)
+
+
+class FleetShow:
+    """One presentation of the fleet, with its own engine and controller."""
+    def __init__(self, name, control_dict, oControl, engine, slide_start=0,
+                 oDoc=None):
+        self.name = name
+        self.control_dict = control_dict
+        self.engine = engine
+        self.slide_start = slide_start
+        self.oDoc = oDoc
+        self.dispatcher = SlideDispatcher(oControl)
+        self.scheduler = AsyncScheduler(self.dispatcher, engine)
+        self.duration = None
+
+    async def run(self, prefetcher):
+        start = time.monotonic()
+        stream = prefetcher.iterate(iter_playlist(self.control_dict,
+                                                  self.slide_start))
+        try:
+            await self.scheduler.present(stream)
+        finally:
+            self.duration = time.monotonic() - start
+            self.dispatcher.stop()
+
+    def report(self):
+        """Return a line of the show's latencies."""
+        waits = sorted(self.scheduler.ready_waits) or [0.0]
+        delays = self.engine.start_delays or [0.0]
+        return ("{}: {:.1f} s, {} clips, ready wait p50 {:.1f} ms p95 {:.1f} "
+                "ms, start delay mean {:.1f} ms".format(
+                        self.name, self.duration or 0.0, self.engine.clips,
+                        waits[int(0.50 * (len(waits) - 1))],
+                        waits[int(0.95 * (len(waits) - 1))],
+                        sum(delays) / len(delays)))
+
+
+def run_fleet(fleet_file, args):
+    """
+    Run the shows of the fleet file at the same time, from one asyncio
+    event loop and one GLib main loop. The shows share the audio cache, 
+    the text to speech backend and one pool of fetch threads, so narration
+    that is the same in several shows is fetched once.
+    LibreOffice is launched only if a show has impress set. Each such show
+    opens its presentation in it.
+    Prints the latencies of each show and the throughput of the fleet.
+    """
+    shows = load_fleet(fleet_file)
+    cache, backend = make_speech_stack(args, args.fallback)
+
+    child = None
+    oDesktop = None
+    if any(show["impress"] for show in shows):
+        child = launch_office(args.office_connection)
+        try:
+            oDesktop = wait_for_office(connection=args.office_connection)
+        except NoConnectException:
+            child.kill()
+            sys.exit("LibreOffice did not accept a connection within {} "
+                     "seconds. Exiting...".format(office_timeout))
+
+    loop_thread = MainLoopThread()
+    fleet = []
+    try:
+        for show in shows:
+            name = os.path.basename(show["control"])
+            impress_file, total_slide, control_dict, totals, control_hash = (
+                    load_control(show["control"]))
+            oDoc = None
+            if show["impress"]:
+                impress_file_path = "{}{}{}".format(os.getcwd(), os.sep,
+                                                    impress_file)
+                oDoc = open_impress_document(
+                        oDesktop, "file:///{}".format(impress_file_path))
+                errors = check_slide_range(control_dict, 
+                                           oDoc.DrawPages.Count)
+                if errors:
+                    print_errors(errors, name)
+                    sys.exit("Exiting...")
+                oDoc.Presentation.start()
+                oControl = wait_for_presentation(oDoc)
+                if oControl is None:
+                    sys.exit("Slide show {} did not start within {} seconds. "
+                             "Exiting...".format(impress_file, 
+                                                 presentation_timeout))
+            else:
+                oControl = NullController()
+            engine = PlaybackEngine(show["audio_sink"], loop_thread)
+            fleet.append(FleetShow(name, control_dict, oControl, engine,
+                                   show["slide_start"], oDoc))
+            if music_cache is not None:
+                music_cache.warm(control_dict)
+        print("Fleet of {} shows.".format(len(fleet)))
+
+        prefetcher = Prefetcher(cache, args.prefetch_depth, backend=backend,
+                                streaming=speech_streaming)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        start = time.monotonic()
+        try:
+            loop.run_until_complete(asyncio.gather(
+                    *[show.run(prefetcher) for show in fleet]))
+        finally:
+            duration = time.monotonic() - start
+            prefetcher.shutdown()
+            loop.close()
+
+        for show in fleet:
+            print(show.report())
+        clips = sum(show.engine.clips for show in fleet)
+        print("Fleet: {} shows in {:.1f} s, {} clips, {:.2f} clips/s. Audio "
+              "cache: {} hits, {} fetched, {} shared with a fetch in flight."
+              .format(len(fleet), duration, clips, clips / duration,
+                      cache.hits, cache.misses - cache.shared, cache.shared))
+        if backend.report():
+            print(backend.report())
+    finally:
+        loop_thread.stop()
+        for show in fleet:
+            show.engine.close()
+            if show.oDoc is not None:
+                show.oDoc.dispose()
+        if child is not None:
+            child.kill()
+
+
+#------------------------------------------------------------------------------
+#   Preflight
+#------------------------------------------------------------------------------
+class ProbeError(Exception):
+    """Raised when an audio file can not be probed."""
+
+
+def probe_audio(file_path, discoverer):
+    """
+    Return the codec description and the duration in seconds of an audio
+    file. Raises ProbeError if it has no audio or can not be read.
+    """
+    try:
+        info = discoverer.discover_uri(
+                Gst.filename_to_uri(os.path.abspath(file_path)))
+    except GLib.Error as e:
+        raise ProbeError(e.message)
+    streams = info.get_audio_streams()
+    if not streams:
+        raise ProbeError("no audio stream")
+    codec = GstPbutils.pb_utils_get_codec_description(streams[0].get_caps())
+    return codec, info.get_duration() / Gst.SECOND
+
+
+def measure_durations(control_dict, cache, backend, skip=()):
+    """
+    Fetch the speech of every paragraph into the cache, all at once, and 
+    probe the codec and duration of every music file and speech clip.
+    Paragraphs whose line number is in skip, e.g. already failed, are not
+    fetched and have no audio.
+    Return a dictionary from the line number of each item to its seconds
+    of audio, or pause, a dictionary from each music file to its (codec, 
+    seconds) and a list of failures, each [line number, item, message].
+    """
+    prefetcher = Prefetcher(cache, 0, backend=backend)
+    speech = []
+    for index in range(len(control_dict)):
+        for item in control_dict[index]:
+            if item[2] in skip:
+                continue
+            futures = prefetcher.submit(item)
+            if futures is not None:
+                speech.append((item, futures))
+
+    # Each thread probes with a discoverer of its own.
+    local = threading.local()
+
+    def probe(file_path):
+        if isinstance(file_path, ArchiveClip):
+            return file_path.codec, file_path.duration
+        if isinstance(file_path, SpeechClip):
+            raise ProbeError("the speech could not be cached")
+        if not hasattr(local, "discoverer"):
+            local.discoverer = GstPbutils.Discoverer.new(10 * Gst.SECOND)
+        return probe_audio(file_path, local.discoverer)
+
+    probe_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=prefetch_workers)
+    durations = {}
+    music = {}
+    probes = []
+    failures = []
+    for index in range(len(control_dict)):
+        for item in control_dict[index]:
+            durations[item[2]] = 0.0
+            if item[0] == "pause":
+                durations[item[2]] = item[1]
+            elif item[0] == "music":
+                probes.append((item, probe_executor.submit(probe, item[1])))
+    for item, futures in speech:
+        for future in futures:
+            audio_file = future.result()
+            if audio_file is None:
+                failures.append([item[2], item, 
+                                 "The speech could not be synthesized."])
+                break
+            probes.append((item, probe_executor.submit(probe, audio_file)))
+
+    for item, future in probes:
+        try:
+            codec, seconds = future.result()
+        except ProbeError as e:
+            failures.append([item[2], item, 
+                             "Unable to probe the audio: {}".format(e)])
+            continue
+        durations[item[2]] += seconds
+        if item[0] == "music":
+            music[item[1]] = (codec, seconds)
+    probe_executor.shutdown()
+    prefetcher.shutdown()
+    return durations, music, failures
+
+
+def preflight(text_file_path, args):
+    """
+    Dry run of the show, without LibreOffice, so it starts with a warm
+    cache and no need of the network.
+    Compile the text/control file. Synthesize the speech of every paragraph
+    into the audio cache and decode the music. Print the codec and duration
+    of the music files, the predicted duration of each slide block and of
+    the show, and the failures. Paragraphs that could not be synthesized 
+    are left out of the durations.
+    Return the number of failures.
+    """
+    impress_file, total_slide, control_dict, totals, control_hash = (
+            load_control(text_file_path))
+    cache, backend = make_speech_stack(args)
+    if music_cache is not None:
+        music_cache.warm(control_dict)
+
+    start = time.monotonic()
+    clips, chars, failures = batch_synthesize(control_dict, cache, backend,
+                                              args.synthesis_workers)
+    print(synthesis_report(clips, chars, time.monotonic() - start))
+    # Failed paragraphs are not fetched again.
+    failed_lines = set(failure[0] for failure in failures)
+    durations, music, probe_failures = measure_durations(
+            control_dict, cache, backend, failed_lines)
+    failures.extend(probe_failures)
+    fetch_time = time.monotonic() - start
+    if music_cache is not None:
+        music_cache.shutdown(wait=True)
+
+    for file_name in sorted(music):
+        print("Music {}: {}, {:.1f} seconds".format(file_name, 
+                                                    *music[file_name]))
+    timeline = Timeline(control_dict, durations)
+    print("\n{:>6} {:>6} {:>10} {:>10}".format("block", "slide", "start",
+                                               "seconds"))
+    for index in range(len(control_dict)):
+        slide_list = control_dict[index]
+        block_start = timeline.planned[slide_list[0][2]]
+        seconds = sum(durations[item[2]] for item in slide_list)
+        print("{:>6} {:>6} {:>10} {:>10.1f}".format(
+                index, slide_list[0][1], format_clock(block_start), seconds))
+    print("Predicted show duration: {}".format(format_clock(timeline.end)))
+    paragraphs = sum(1 for slide_list in control_dict.values() 
+                     for item in slide_list if is_text_item(item[0]))
+    print("{} paragraphs checked in {:.1f} s. Audio cache: {} hits, {} "
+          "misses".format(paragraphs, fetch_time, cache.hits, cache.misses))
+    if failures:
+        print_errors(failures, os.path.basename(text_file_path))
+    return len(failures)
+
+
+#------------------------------------------------------------------------------
+#   Batch synthesis
+#------------------------------------------------------------------------------
+def synthesize_to_file(engine, text, language, directory):
+    """
+    Run in a worker process. Synthesize the text with a local engine into
+    a temporary file in directory and return its path. Raises 
+    SynthesisError.
+    """
+    data = LocalEngineBackend(engine).synthesize(text, language)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return temp_path
 
-                if key == "zh-TW" or key == "zh-CN":
-                    # Two chinese languages have 5 x characters. 
-                    #text_to_speech(value, key, mp3_player)
-                    # Create the uri for google  
-                    s = 'https://translate.google.com/translate_tts?'
-                    s = s + 'ie=UTF-8&client=tw-ob&tl={}&q={}'
-                    audio_string = s.format(key,value)
-                    #print(audio_string)
-                    play_audio(audio_string, player, loop) 
+
+def batch_synthesize(control_dict, cache, backend, workers=None):
+    """
+    Synthesize the speech of every paragraph of the show, in every language,
+    into the audio cache. Each chunk of text not already cached is 
+    synthesized once.
+    Local engines are run from a pool of worker processes, by default one
+    per core. Each worker writes its clip into the cache folder and it is
+    moved into the cache. Other backends are sent the requests from a pool
+    of threads, up to the concurrency they allow.
+    Return the number of clips and of characters synthesized, and a list of
+    failures, each [line number, item, message].
+    """
+    jobs = collections.OrderedDict()
+    for index in range(len(control_dict)):
+        for item in control_dict[index]:
+            if not is_text_item(item[0]):
+                continue
+            for chunk in split_text(item[1], item[0]):
+                key = cache.make_key(chunk, item[0], backend.name)
+                if key in jobs or cache.path(key, count=False) is not None:
                     continue
-    #oDoc.Presentation.dispose()
+                if (audio_archive is not None and 
+                        audio_archive.speech(key) is not None):
+                    continue
+                jobs[key] = (chunk, item[0], item)
+
+    failures = []
+    failed = set()
+    if isinstance(backend, LocalEngineBackend):
+        executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count() or 1)
+        futures = [(key, executor.submit(synthesize_to_file, backend.name,
+                                         text, language, cache.directory))
+                   for key, (text, language, item) in jobs.items()]
+        for key, future in futures:
+            try:
+                cache.store_file(key, future.result(), backend.extension)
+            except (SynthesisError, OSError) as e:
+                failed.add(key)
+                item = jobs[key][2]
+                failures.append([item[2], item, 
+                                 "The speech could not be synthesized: {}"
+                                 .format(e)])
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(workers or backend.max_concurrency,
+                                       backend.max_concurrency)))
+        futures = [(key, executor.submit(speech_file, text, language, cache,
+                                         backend))
+                   for key, (text, language, item) in jobs.items()]
+        for key, future in futures:
+            result = future.result()
+            if result is None or isinstance(result, SpeechClip):
+                failed.add(key)
+                item = jobs[key][2]
+                if result is None:
+                    message = "The speech could not be synthesized."
+                else:
+                    message = "The speech could not be cached."
+                failures.append([item[2], item, message])
+    executor.shutdown()
+    chars = sum(len(jobs[key][0]) for key in jobs if key not in failed)
+    return len(jobs) - len(failed), chars, failures
+
+
+def synthesis_report(clips, chars, seconds):
+    """Return a line of the batch synthesis throughput."""
+    seconds = max(seconds, 1e-6)
+    return ("Synthesized {} clips, {} characters in {:.1f} s: {:.0f} "
+            "characters/s, {:.1f} clips/s".format(clips, chars, seconds,
+                                                  chars / seconds,
+                                                  clips / seconds))
+
+
+def synthesize_all(text_file_path, args):
+    """
+    Compile the text/control file and synthesize all its speech into the 
+    audio cache. Print the throughput and the failures. Return the number
+    of failures.
+    """
+    impress_file, total_slide, control_dict, totals, control_hash = (
+            load_control(text_file_path))
+    cache, backend = make_speech_stack(args)
+    start = time.monotonic()
+    clips, chars, failures = batch_synthesize(control_dict, cache, backend,
+                                              args.synthesis_workers)
+    print(synthesis_report(clips, chars, time.monotonic() - start))
+    if failures:
+        print_errors(failures, os.path.basename(text_file_path))
+    return len(failures)
+
+
+#------------------------------------------------------------------------------
+#   Timeline
+#------------------------------------------------------------------------------
+def parse_clock(value):
+    """
+    Return the seconds of a time given as seconds, m:s or h:m:s, e.g. 90,
+    1:30 or 0:01:30.5. Raises ValueError.
+    """
+    fields = value.split(":")
+    if len(fields) > 3:
+        raise ValueError(value)
+    seconds = 0.0
+    for field in fields:
+        seconds = seconds * 60 + float(field)
+    return seconds
+
+
+def format_clock(seconds):
+    """Return seconds as m:ss.s"""
+    return "{}:{:04.1f}".format(int(seconds // 60), seconds % 60)
+
+
+class Timeline:
+    """
+    Target start time of each item of the show, in seconds from the start.
+    A slide block starts at its [cue:] time, if it has one, else when the
+    block before it is planned to end. Within a block, each item is 
+    planned to start when the one before it is planned to end, using the
+    measured durations of the audio.
+    The show waits for a slide block that is early. A pause ends at its
+    planned time, so a show running late catches up in the pauses. The 
+    drift of each slide block from its target is recorded.
+    """
+    def __init__(self, control_dict, durations):
+        """durations is a dictionary from line number to seconds."""
+        self.planned = {}
+        self.block_starts = set()
+        t = 0.0
+        for index in range(len(control_dict)):
+            slide_list = control_dict[index]
+            for item in slide_list:
+                if item[0] == "cue":
+                    t = item[1]
+            self.block_starts.add(slide_list[0][2])
+            for item in slide_list:
+                self.planned[item[2]] = t
+                t += durations.get(item[2], 0.0)
+        self.end = t
+        self.start = None
+        # Lateness of each slide block, then of the end. In milliseconds.
+        self.drifts = []
+        self.end_drift = None
+
+    def target(self, item):
+        """Return the time.monotonic() the item is planned to start."""
+        if self.start is None:
+            # The show starts with this item, e.g. at slide_start.
+            self.start = time.monotonic() - self.planned[item[2]]
+        return self.start + self.planned[item[2]]
+
+    def delay(self, item):
+        """Return the seconds to wait before a slide block that is early."""
+        if item[2] not in self.block_starts:
+            return 0.0
+        return max(self.target(item) - time.monotonic(), 0.0)
+
+    def reached(self, item):
+        """Record the drift of a slide block as it starts."""
+        if item[2] not in self.block_starts:
+            return
+        drift = (time.monotonic() - self.target(item)) * 1000
+        self.drifts.append(drift)
+        tracer.instant("cue", "timeline", line=item[2], drift_ms=drift)
+
+    def pause_time(self, item):
+        """Return the seconds to pause for the pause to end on time."""
+        if item[2] not in self.planned:
+            # Added by a reload.
+            return item[1]
+        return max(self.target(item) + item[1] - time.monotonic(), 0.0)
+
+    def finish(self):
+        if self.start is not None:
+            self.end_drift = ((time.monotonic() - self.start - self.end) *
+                              1000)
+
+    def report(self):
+        """Return a line summarizing the drift from the planned times."""
+        if not self.drifts:
+            return "Timeline drift: no slide blocks presented."
+        line = ("Timeline drift: {} slide blocks, mean {:.1f} ms, max "
+                "{:.1f} ms late.".format(len(self.drifts), 
+                                         sum(self.drifts) / len(self.drifts),
+                                         max(self.drifts)))
+        if self.end_drift is not None:
+            line += " Show ended {:+.1f} ms from the plan.".format(
+                    self.end_drift)
+        return line
+
+
+#------------------------------------------------------------------------------
+#   Trace
+#------------------------------------------------------------------------------
+class NullSpan:
+    """Context manager that does nothing. Used when tracing is off."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Tracer:
+    """
+    Record the timing of each item of the show as Chrome trace events, for
+    viewing in chrome://tracing or https://ui.perfetto.dev
+    Events are recorded for slide changes, pauses, music, speech fetches, 
+    the first audio of each run and each clip played. 
+    When not enabled, span() returns a shared null context and the other
+    methods return at once, so the hooks cost next to nothing.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.pid = os.getpid()
+
+    def add(self, event):
+        event["pid"] = self.pid
+        event["tid"] = threading.get_ident()
+        with self.lock:
+            self.events.append(event)
+
+    def span(self, name, category, **args):
+        """Return a context manager recording its body as an event."""
+        if not self.enabled:
+            return null_span
+        return self.timed_span(name, category, args)
+
+    @contextlib.contextmanager
+    def timed_span(self, name, category, args):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.complete(name, category, start, time.monotonic(), **args)
+
+    def complete(self, name, category, start, end, **args):
+        """Record an event from start to end, in time.monotonic() seconds."""
+        if not self.enabled:
+            return
+        self.add({"name": name, "cat": category, "ph": "X",
+                  "ts": (start - self.start) * 1e6,
+                  "dur": (end - start) * 1e6, "args": args})
+
+    def instant(self, name, category, **args):
+        """Record an event at the current time."""
+        if not self.enabled:
+            return
+        self.add({"name": name, "cat": category, "ph": "i", "s": "t",
+                  "ts": (time.monotonic() - self.start) * 1e6, 
+                  "args": args})
+
+    def write(self, file_path):
+        """Write the events as a Chrome trace event JSON file."""
+        with self.lock:
+            events = list(self.events)
+        with open(file_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """
+        Return a list of [name, count, p50, p95, max] for each kind of
+        event with a duration. Times are in milliseconds.
+        """
+        durations = collections.defaultdict(list)
+        with self.lock:
+            for event in self.events:
+                if event["ph"] == "X":
+                    durations[event["name"]].append(event["dur"] / 1000)
+        rows = []
+        for name in sorted(durations):
+            values = sorted(durations[name])
+            rows.append([name, len(values), 
+                         values[int(0.50 * (len(values) - 1))],
+                         values[int(0.95 * (len(values) - 1))],
+                         values[-1]])
+        return rows
+
+    def print_summary(self):
+        """Print the latency summary table."""
+        print("{:<14} {:>6} {:>10} {:>10} {:>10}"
+              .format("phase", "count", "p50 ms", "p95 ms", "max ms"))
+        for name, count, p50, p95, maximum in self.summary():
+            print("{:<14} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}"
+                  .format(name, count, p50, p95, maximum))
+
+
+# Tracing is enabled with the --trace command line option.
+tracer = Tracer()
+
+
+#------------------------------------------------------------------------------
+#   Playback engine
+#------------------------------------------------------------------------------
+class PlaybackEngine:
+    """
+    Plays audio files through a single playbin that is kept for the whole
+    presentation.
+    A run of files is played back-to-back. While a file is playing, playbin
+    emits about-to-finish and the next file of the run is queued, so there 
+    is no pipeline teardown between clips. Between runs the pipeline is only
+    dropped to READY, not NULL.
+    The gap between consecutive clips is measured from the stream-start of 
+    each clip, less the duration of the clip before it.
+    """
+    def __init__(self, audio_sink=None, loop_thread=None):
+        """
+        Initialize GObject.threads, Gst, player, loop and bus.
+        Create a fakesink to bury any video.
+        audio_sink describes the element to play the audio with, as for 
+        gst-launch, e.g. fakesink or alsasink device=hw:1. By default 
+        playbin chooses the sink.
+        loop_thread is a MainLoopThread shared with other engines, for 
+        several shows run from one asyncio event loop.
+        Bus is set up to perfom a call back to bus_call() every time a
+        playbin message is generated.
+        """
+        # Init
+        GObject.threads_init()
+        Gst.init(None)
+        # Instantiate    
+        self.player = Gst.ElementFactory.make("playbin", 'player')
+        if not self.player:
+            sys.stderr.write("'playbin' gstreamer plugin missing\n")
+            sys.exit(1)
+        fakesink = Gst.ElementFactory.make("fakesink", "fakesink")
+        self.player.set_property("video-sink", fakesink)
+        if audio_sink is not None:
+            sink = Gst.parse_launch(audio_sink)
+            if audio_sink == "fakesink":
+                # Consume the audio in real time, as a sound card would.
+                sink.set_property("sync", True)
+            self.player.set_property("audio-sink", sink)
+        self.player.connect("about-to-finish", self.about_to_finish)
+        self.player.connect("source-setup", self.source_setup)
+
+        # Instantiate the event loop .
+        if loop_thread is None:
+            self.loop = GObject.MainLoop()
+        else:
+            self.loop = loop_thread.loop
+        # Instantiate and initialize the bus call-back 
+        bus = self.player.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self.bus_call)
+
+        self.sources = iter(())
+        # Sources set on playbin that have not yet started, for the trace.
+        self.queued_sources = collections.deque()
+        # Decoded music and archive clips set on playbin, waiting for 
+        # their appsrc.
+        self.pending_assets = collections.deque()
+        self.clip_source = None
+        self.error = False
+        # Timing of the clip that is playing, in seconds.
+        self.clip_start = None
+        self.clip_duration = None
+        self.run_start = None
+        # Measured gaps between back-to-back clips and the delays from a
+        # call to play() to the first clip starting. In milliseconds.
+        self.gaps = []
+        self.start_delays = []
+        # Time of the last seek, until its first audio starts, and the 
+        # measured seek to first audio latencies. In milliseconds.
+        self.seek_time = None
+        self.seek_latencies = []
+        self.stopped = False
+        # With the asyncio scheduler, the main loop runs in its own thread
+        # and the end of a run is signalled with on_finish().
+        self.loop_thread = loop_thread
+        self.on_finish = None
+        # Clips started.
+        self.clips = 0
+        # Time to first byte and to first audio of each streamed clip, in
+        # milliseconds.
+        self.stream_latencies = []
+        # The clip playing, the clip that has been retried after an error,
+        # and the count of clips retried and skipped.
+        self.playing_source = None
+        self.retried_source = None
+        self.retried = 0
+        self.skipped = 0
+
+    @staticmethod
+    def to_uri(audio_source):
+        """
+        Determine is audio source is a uri or convert the filename to uri
+        format. E.g. file:///home/ian1/Desktop/audio/hello.mp3
+        """
+        if Gst.uri_is_valid(audio_source):
+            return audio_source
+        return Gst.filename_to_uri(os.path.abspath(audio_source))
+
+    def play(self, sources):
+        """
+        Play each audio file or uri from the iterable sources back-to-back.
+        The iterable may block, e.g. waiting for speech to be fetched. It is
+        read from the streaming thread as each clip is about to finish.
+        Enter loop waiting for the last clip to finish.
+        """
+        if not self.start(sources):
+            return
+        # Loop while waiting for audio to finish. 
+        self.loop.run()
+        self.finish()
+
+    def start(self, sources):
+        """
+        Start playing the sources and return without waiting. Return False
+        if there is nothing to play. The run is ended by end_run().
+        """
+        self.sources = iter(sources)
+        audio_source = next(self.sources, None)
+        if audio_source is None:
+            return False
+        self.error = False
+        self.stopped = False
+        self.clip_start = None
+        self.run_start = time.monotonic()
+        self.playing_source = None
+        self.retried_source = None
+        self.queued_sources.clear()
+        self.pending_assets.clear()
+        self.set_source(self.player, audio_source)
+
+        # Start streaming the audio.
+        self.player.set_state(Gst.State.PLAYING)
+        return True
+
+    def finish(self):
+        """Keep the pipeline ready for the next run, unless it failed."""
+        if self.error:
+            self.player.set_state(Gst.State.NULL)
+        else:
+            self.player.set_state(Gst.State.READY)
+        self.sources = iter(())
+
+    def play_async(self, sources):
+        """
+        Start playing the sources from a coroutine. Return an asyncio future
+        that is done when the run ends, or None if there is nothing to play.
+        The main loop must be running, see start_loop_thread(). Call 
+        finish() once the future is done.
+        """
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        self.on_finish = lambda: loop.call_soon_threadsafe(resolve, done)
+        if not self.start(sources):
+            self.on_finish = None
+            return None
+        return done
+
+    def start_loop_thread(self):
+        """Run the main loop in a thread, for the bus messages."""
+        self.loop_thread = MainLoopThread(self.loop)
+
+    def stop_loop_thread(self):
+        if self.loop_thread is not None:
+            self.loop_thread.stop()
+            self.loop_thread = None
+
+    def end_run(self):
+        """The run has ended. Wake whatever is waiting for it."""
+        on_finish, self.on_finish = self.on_finish, None
+        if on_finish is not None:
+            on_finish()
+        elif self.loop_thread is None:
+            self.loop.quit()
+
+    def remaining(self):
+        """
+        Return the seconds left of the clip playing, if it is the last of
+        the run, else 0.
+        """
+        if self.clip_start is None or self.clip_duration is None:
+            return 0.0
+        return max(self.clip_start + self.clip_duration - time.monotonic(),
+                   0.0)
+
+    def about_to_finish(self, playbin):
+        """
+        Called from the streaming thread while the current clip is still
+        playing. Record its duration and queue the next clip of the run. If
+        there is none, playbin goes on to End-of-Stream.
+        """
+        ok, duration = playbin.query_duration(Gst.Format.TIME)
+        if ok:
+            self.clip_duration = duration / Gst.SECOND
+        else:
+            self.clip_duration = None
+        audio_source = next(self.sources, None)
+        if audio_source is not None:
+            self.set_source(playbin, audio_source)
+
+    def set_source(self, playbin, audio_source):
+        """
+        Set the clip for playbin to play next. Decoded music and archive 
+        clips are played from an appsrc, set up in source_setup().
+        """
+        self.queued_sources.append(audio_source)
+        if isinstance(audio_source, AppSource):
+            self.pending_assets.append(audio_source)
+            playbin.set_property('uri', "appsrc://")
+        else:
+            playbin.set_property('uri', self.to_uri(audio_source))
+
+    def source_setup(self, playbin, source):
+        """Called by playbin with the source element of each clip."""
+        if source.get_factory().get_name() != "appsrc":
+            return
+        if self.pending_assets:
+            self.pending_assets.popleft().feed(source)
+
+    def bus_call(self, bus, message):
+        """
+        Call back for messages generated when playbin is playing.
+        Stream-start marks the start of each clip and is used to measure
+        the gaps.
+        The End-of-Stream, EOS, message indicates the audio is complete and
+        the waiting loop is quit.
+        """
+        t = message.type
+        if t == Gst.MessageType.STREAM_START:
+            now = time.monotonic()
+            self.clips += 1
+            if self.clip_start is None:
+                self.start_delays.append((now - self.run_start) * 1000)
+                tracer.complete("first audio", "playback", self.run_start, 
+                                now)
+                if self.seek_time is not None:
+                    latency = (now - self.seek_time) * 1000
+                    self.seek_latencies.append(latency)
+                    tracer.complete("seek to audio", "playback",
+                                    self.seek_time, now)
+                    print("First audio {:.0f} ms after seek.".format(latency))
+                    self.seek_time = None
+            else:
+                if self.clip_duration is not None:
+                    gap = now - self.clip_start - self.clip_duration
+                    self.gaps.append(max(gap, 0.0) * 1000)
+                tracer.complete("play clip", "playback", self.clip_start,
+                                now, source=self.clip_source)
+            self.clip_start = now
+            if self.queued_sources:
+                source = self.queued_sources.popleft()
+                if isinstance(source, StreamingClip):
+                    self.first_audio(source, now)
+                self.playing_source = source
+                self.clip_source = os.path.basename(str(source))
+
+        elif t == Gst.MessageType.EOS:
+            # End-of-Stream therefore quit loop.
+            #sys.stdout.write("End-of-stream\n")
+            if self.clip_start is not None:
+                tracer.complete("play clip", "playback", self.clip_start,
+                                time.monotonic(), source=self.clip_source)
+            tracer.instant("EOS", "playback")
+            self.end_run()
+
+        elif t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            sys.stderr.write("Error: %s: %s\n" % (err, debug))
+            if self.retry_clip():
+                return True
+            self.error = True
+            self.end_run()
+        return True
+
+    def retry_clip(self):
+        """
+        After an error, play the clip that failed again, then go on with
+        the rest of the run. A clip that fails twice is skipped. Return 
+        False if there is nothing left to play.
+        """
+        if self.stopped:
+            return False
+        if self.queued_sources:
+            # Failed before it started.
+            source = self.queued_sources[0]
+        else:
+            source = self.playing_source
+        name = os.path.basename(str(source))
+        if isinstance(source, StreamingClip):
+            # Played from the cache once it is complete.
+            source = source.path if source.done.is_set() else None
+        if source is None or source == self.retried_source:
+            self.skipped += 1
+            print("Skipping audio clip {}.".format(name))
+            source = next(self.sources, None)
+            if source is None:
+                return False
+            self.retried_source = None
+        else:
+            self.retried += 1
+            print("Retrying audio clip {}.".format(name))
+            self.retried_source = source
+        self.player.set_state(Gst.State.NULL)
+        self.queued_sources.clear()
+        self.pending_assets.clear()
+        self.set_source(self.player, source)
+        self.player.set_state(Gst.State.PLAYING)
+        return True
+
+    def error_report(self):
+        """Return a line counting the clips retried and skipped."""
+        return ("Playback errors: {} clips retried, {} skipped."
+                .format(self.retried, self.skipped))
+
+    def gap_report(self):
+        """Return a line summarizing the measured inter-clip gaps."""
+        if not self.gaps:
+            return "Inter-clip gap: no back-to-back clips measured."
+        return ("Inter-clip gap: {} clips, mean {:.1f} ms, max {:.1f} ms. "
+                "Start delay: mean {:.1f} ms."
+                .format(len(self.gaps), sum(self.gaps) / len(self.gaps),
+                        max(self.gaps), 
+                        sum(self.start_delays) / len(self.start_delays)))
+
+    def first_audio(self, clip, now):
+        """A streamed clip has started playing. Record its latencies."""
+        if clip.ttfa is not None:
+            # Played again, from the cache.
+            return
+        clip.ttfa = (now - clip.start) * 1000
+        self.stream_latencies.append((clip.ttfb, clip.ttfa))
+        tracer.complete("time to first audio", "tts", clip.start, now,
+                        clip=clip.key)
+
+    def stream_report(self):
+        """Return a line summarizing the latencies of the streamed clips."""
+        ttfb = [latencies[0] for latencies in self.stream_latencies]
+        ttfa = [latencies[1] for latencies in self.stream_latencies]
+        return ("Streamed speech: {} clips, time to first byte mean {:.1f} "
+                "ms, max {:.1f} ms, time to first audio mean {:.1f} ms, "
+                "max {:.1f} ms."
+                .format(len(ttfb), sum(ttfb) / len(ttfb), max(ttfb),
+                        sum(ttfa) / len(ttfa), max(ttfa)))
+
+    def seek_report(self):
+        """Return a line summarizing the seek to first audio latencies."""
+        return ("Seek to first audio: {} seeks, mean {:.1f} ms, max {:.1f} ms."
+                .format(len(self.seek_latencies), 
+                        sum(self.seek_latencies) / len(self.seek_latencies),
+                        max(self.seek_latencies)))
+
+    def stop(self):
+        """
+        Stop the run that is playing. Called from another thread. No more
+        clips are queued and the waiting loop is quit from the main loop.
+        If the run has not yet entered the loop it is quit as it does.
+        """
+        self.stopped = True
+        self.sources = iter(())
+        GObject.idle_add(self.quit_if_stopped)
+
+    def quit_if_stopped(self):
+        if self.stopped:
+            self.stopped = False
+            self.end_run()
+        return False
+
+    def close(self):
+        """Set the playbin state to Null."""
+        self.player.set_state(Gst.State.NULL)
+
+
+#------------------------------------------------------------------------------ 
+#   Launch functions - A collection of functions used before passing to main()
+#------------------------------------------------------------------------------
+def parse_arguments(argv=None):
+    """
+    Parse the command line.
+    The optional positional argument is the slide to start at, as before.
+    """
+    parser = argparse.ArgumentParser(
+            description="Deliver an Impress slide show with google text to "
+                        "speech commentary.")
+    parser.add_argument("slide_start", nargs="?", type=int,
+                        default=slide_start,
+                        help="index of the first slide to present "
+                             "(default: %(default)s)")
+    parser.add_argument("--backend", default=tts_backend,
+                        choices=["google", "espeak", "pico", "http"],
+                        help="text to speech backend (default: %(default)s)")
+    parser.add_argument("--backend-url", default=http_backend_url,
+                        help="url of the http backend, with {language} and "
+                             "{text} fields")
+    parser.add_argument("--http-pool-size", type=int, default=http_pool_size,
+                        help="keep-alive connections per host "
+                             "(default: %(default)s)")
+    parser.add_argument("--http-timeout", type=float, default=http_timeout,
+                        help="seconds to wait for the text to speech server "
+                             "(default: %(default)s)")
+    parser.add_argument("--http-max-requests", type=int,
+                        default=http_max_requests,
+                        help="requests sent on one connection before it is "
+                             "closed (default: %(default)s)")
+    parser.add_argument("--fetch-deadline", type=float, 
+                        default=fetch_deadline,
+                        help="seconds a paragraph of speech may take, "
+                             "retries included (default: %(default)s)")
+    parser.add_argument("--fetch-rate", type=float,
+                        help="most speech requests per second sent to the "
+                             "google or http backend")
+    parser.add_argument("--fetch-concurrency", type=int,
+                        help="most speech requests in flight to the google "
+                             "or http backend, adapted below this to the "
+                             "server's answers")
+    parser.add_argument("--no-hedge", action="store_true",
+                        help="do not send a second request when the text "
+                             "to speech server is slow")
+    parser.add_argument("--fallback", default=str(fallback_engine),
+                        choices=["espeak", "pico", "None"],
+                        help="local engine used when the speech can not be "
+                             "fetched in time (default: %(default)s)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write a Chrome trace event file of the show "
+                             "and print a summary of the latencies")
+    parser.add_argument("--stream", action="store_true",
+                        help="start presenting while the control file is "
+                             "still being parsed, for very long files")
+    parser.add_argument("--stream-window", type=int, default=stream_window,
+                        help="with --stream, slide blocks parsed ahead of "
+                             "the one presenting (default: %(default)s)")
+    parser.add_argument("--watch", action="store_true",
+                        help="reload the control file when it changes, "
+                             "continuing from the current slide")
+    parser.add_argument("--interactive", action="store_true",
+                        help="control the show from the keyboard: next, "
+                             "previous, go to slide and replay")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run the show from an asyncio event loop, "
+                             "sending slide changes ahead of the audio")
+    parser.add_argument("--fleet", metavar="FILE",
+                        help="run the shows listed in a JSON fleet file at "
+                             "the same time, sharing the audio cache")
+    parser.add_argument("--no-music-cache", action="store_true",
+                        help="decode the music files each time they are "
+                             "played, instead of once")
+    parser.add_argument("--preflight", action="store_true",
+                        help="fetch all the speech, probe the audio and "
+                             "predict the show duration, then exit")
+    parser.add_argument("--timeline", action="store_true",
+                        help="keep slide blocks to their [cue:] times, or "
+                             "to times computed from the audio, and report "
+                             "the drift")
+    parser.add_argument("--office-host", default=office_host,
+                        help="host LibreOffice accepts connections on "
+                             "(default: %(default)s)")
+    parser.add_argument("--office-port", type=int, default=office_port,
+                        help="port LibreOffice accepts connections on "
+                             "(default: %(default)s)")
+    parser.add_argument("--office-pipe", metavar="NAME",
+                        help="connect to LibreOffice through a named pipe "
+                             "instead of a socket")
+    parser.add_argument("--office-connection", 
+                        help="UNO connection string, e.g. "
+                             "\"pipe,name=google_talk\", overriding the "
+                             "host, port and pipe")
+    parser.add_argument("--synthesize-all", action="store_true",
+                        help="synthesize the speech of the whole control "
+                             "file into the cache, then exit")
+    parser.add_argument("--synthesis-workers", type=int,
+                        help="processes running a local engine for "
+                             "--synthesize-all and --preflight (default: "
+                             "one per core)")
+    parser.add_argument("--export-archive", metavar="FILE",
+                        help="pack all the speech and music of the show into "
+                             "one archive file, then exit")
+    parser.add_argument("--archive", metavar="FILE",
+                        help="play the speech and music from a packed "
+                             "archive")
+    parser.add_argument("--stream-speech", action="store_true",
+                        help="play speech not in the cache as it arrives, "
+                             "instead of once it is all fetched")
+    parser.add_argument("--prefetch-depth", type=int, default=prefetch_depth,
+                        help="paragraphs of speech to fetch ahead of the one "
+                             "playing (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.fallback == "None":
+        args.fallback = None
+    if args.office_connection is None:
+        args.office_connection = office_connection_string(
+                args.office_host, args.office_port, args.office_pipe)
+    if args.stream and args.watch:
+        parser.error("--stream and --watch can not be used together")
+    if args.stream and args.interactive:
+        parser.error("--stream and --interactive can not be used together")
+    if args.asyncio and args.interactive:
+        parser.error("--asyncio and --interactive can not be used together")
+    if args.asyncio and args.watch:
+        parser.error("--asyncio and --watch can not be used together")
+    if args.timeline and (args.stream or args.interactive or args.watch):
+        parser.error("--timeline can not be used with --stream, "
+                     "--interactive or --watch")
+    if args.fetch_rate is not None and args.fetch_rate <= 0:
+        parser.error("--fetch-rate must be more than 0")
+    if args.fetch_concurrency is not None and args.fetch_concurrency < 1:
+        parser.error("--fetch-concurrency must be at least 1")
+    return args
+
+
+def select_audio_player(mp3_player_list, mp3_player):
+    """
+    Provide selection of the mp3 player application to use.
+    Based on items in mp3_player_list. Set mp3_player.
+    """
+    while True:
+        print("Select the mp3 player application...")
+        for index, item in enumerate(mp3_player_list):
+            print("\t{}. {}".format(index, item))
+        response = input("Select desired mp3 player [{}]: ".format(mp3_player))
+        if response == "":
+            response = mp3_player
+            break
+        else:
+            try: 
+                response = abs(int(response))
+                mp3_player = mp3_player_list[response]
+                break
+            except:
+                print("Invalid response. Please re-enter...")
+                continue            
+    print("MP3 data will be reproduced as audio with the application {}."
+          .format(mp3_player))
+    return mp3_player
+
+ 
+def audio_test():
+    """ 
+    Test audio. 
+    """
+    while True:
+        print("Audio level check...")   
+        message = "Audio level check." # One, two, three. Check."
+        text_to_speech(message, 'en')
+        response = input("Audio level OK? [Yes]")
+        if response == "":
+            break
+        else:
+            if response[0].lower() in ["y", "1", "t"]:
+                break
+            else:
+                continue
+
+ 
+def office_connection_string(host=office_host, port=office_port, 
+                             pipe=None):
+    """Return the UNO connection string for a pipe, or a socket."""
+    if pipe is not None:
+        return "pipe,name={}".format(pipe)
+    return "socket,host={},port={}".format(host, port)
+
+
+def launch_office(connection=office_connection):
+    """Launch LibreOffice, accepting UNO connections. Return the process."""
+    return subprocess.Popen(args = ("soffice", "--accept={};urp;StarOffice.ServiceManager".format(connection)))
+
+
+def connection_to_libreoffice(connection=office_connection):
+    """Establish python connection to LibreOffice and return the desktop"""
+    
+    localContext = uno.getComponentContext()
+				       
+    resolver = localContext.ServiceManager.createInstanceWithContext(
+	    "com.sun.star.bridge.UnoUrlResolver", localContext)
+    
+    smgr = resolver.resolve(
+        "uno:{};urp;StarOffice.ServiceManager".format(connection))
+
+    # Alternative port 8100
+    #smgr = resolver.resolve(
+    #    "uno:socket,host=localhost,port=8100;urp;StarOffice.ServiceManager")
+    
+    remoteContext = smgr.getPropertyValue("DefaultContext")
+
+    desktop = smgr.createInstanceWithContext("com.sun.star.frame.Desktop",
+            remoteContext)
+
+    return desktop
+        
+    #Alternative variable naming:
+    #mycontext = uno.getComponentContext()
+    #resolver = mycontext.ServiceManager.createInstanceWithContext
+    #    ("com.sun.star.bridge.UnoUrlResolver", mycontext)
+    #myapi = resolver.resolve
+    #    ("uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext")
+
+
+def wait_for_office(timeout=office_timeout, connection=office_connection,
+                    cancel=None):
+    """
+    Poll the LibreOffice socket until it accepts the connection. The delay
+    between attempts doubles from 50 ms up to 1 second. Return the desktop.
+    Raises NoConnectException if not connected within timeout seconds.
+    Return None straight away once the threading.Event cancel is set.
+    """
+    if cancel is None:
+        cancel = threading.Event()
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while not cancel.is_set():
+        try:
+            return connection_to_libreoffice(connection)
+        except NoConnectException:
+            if time.monotonic() + delay > deadline:
+                raise
+            cancel.wait(delay)
+            delay = min(delay * 2, 1.0)
+    return None
+
+
+def open_impress_document(desktop, presentation): 
+    """Open an existing Impress document."""
+    return desktop.loadComponentFromURL(presentation,"_blank", 0, () )
+    
+
+def wait_for_presentation(oDoc, timeout=presentation_timeout):
+    """
+    After oDoc.Presentation.start(), poll until the slide show is running
+    and its controller is available. Return the controller, or None if it 
+    is not available within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        if oDoc.Presentation.isRunning():
+            oControl = oDoc.Presentation.getController()
+            if oControl is not None:
+                return oControl
+        if time.monotonic() + delay > deadline:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def load_control(text_file_path, max_slide=None):
+    """
+    Load the compiled plan if the text/control file, Impress file and music
+    files have not changed since it was written. Otherwise read and compile
+    the text/control file. If max_slide is None the slide numbers are not
+    checked against the presentation.
+    Exits if the text/control file has errors.
+    Return the Impress file name, the total slides recorded in the plan or
+    None, the control_dict, the command totals and the control file hash.
+    """
+    plan_file_path = plan_path(text_file_path)
+    try:
+        control_hash = file_hash(text_file_path)
+    except FileNotFoundError:
+        # Reported by read_text_file() below.
+        control_hash = None
+    plan = load_plan(plan_file_path, control_hash)
+    if plan is not None:
+        impress_file, total_slide, control_dict, totals = plan
+        print("Loaded compiled plan: {}".format(plan_file_path))
+        return impress_file, total_slide, control_dict, totals, control_hash
+
+    # Read text/control to a list without the \n's at the end of lines.
+    slide_data_list = read_text_file(text_file_path)
+    #print(slide_data_list)
+
+    # Get slide show default path and filename and Check file exists.
+    # e.g. [slide_show_file:slide_test_v1.odp]
+    impress_file, impress_file_path = get_slide_show_filename(
+            slide_data_list)
+
+    # Check the commands and build the dictionary to control the
+    # presentation in one pass. Report all errors found and exit.
+    # Of all the slides some may not be shown others may be shown twice, etc.
+    control_dict, totals, errors = compile_control(slide_data_list, 
+                                                   max_slide,
+                                                   language_code_dict)
+    if errors:
+        print_errors(errors, os.path.basename(text_file_path))
+        sys.exit("Exiting...")
+    return impress_file, None, control_dict, totals, control_hash
+
+
+def warm_cache(control_dict, slide_start, count, cache, backend):
+    """
+    Start fetching the speech for the first count paragraphs of the show
+    into the audio cache. Return the prefetcher. Its shutdown(wait=True)
+    waits for the fetches to complete.
+    """
+    prefetcher = Prefetcher(cache, count, backend=backend)
+    for item in iter_playlist(control_dict, slide_start):
+        if count <= 0:
+            break
+        if prefetcher.submit(item) is not None:
+            count -= 1
+    return prefetcher
+
+
+class StartupTimer:
+    """
+    Record the start time and duration of each phase of the startup.
+    Phases may run at the same time in different threads.
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as the named phase."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((start - self.start, 
+                                time.monotonic() - start, name))
+
+    def report(self):
+        """Print the phases in the order they started."""
+        print("Startup timing (seconds):")
+        print("    {:>7} {:>7}  {}".format("start", "took", "phase"))
+        for start, duration, name in sorted(self.phases):
+            print("    {:7.3f} {:7.3f}  {}".format(start, duration, name))
+        print("    {:7.3f} total".format(time.monotonic() - self.start))
+
+
+def read_text_file(text_file_path):
+    """
+    Read the text file for the control of the presentation.
+    """
+    try:
+        with open(text_file_path,"r") as f:
+            # Read to a list without the \n's at the end of lines.
+            return f.read().splitlines()
+    except FileNotFoundError as e:
+        print("Attempted to open text file for the slide presentation.")
+        print("FileNotFoundError: {}".format(e.strerror))
+        print("The path or file is invalid: {}".format(e.filename))
+        sys.exit("Exiting...")
+
+
+def iter_text_file(text_file_path):
+    """
+    Read the text file for the control of the presentation one line at a
+    time, without the \n's at the end of lines.
+    """
+    try:
+        f = open(text_file_path,"r")
+    except FileNotFoundError as e:
+        print("Attempted to open text file for the slide presentation.")
+        print("FileNotFoundError: {}".format(e.strerror))
+        print("The path or file is invalid: {}".format(e.filename))
+        sys.exit("Exiting...")
+    with f:
+        for line in f:
+            yield line.rstrip("\r\n")
+
+
+class BlockStream:
+    """
+    Parse the text/control file in a background thread while the show is
+    presenting. Each slide block is handed over as soon as it is completed,
+    so the first slide plays before the rest of the file has been read.
+    At most window blocks are held waiting, so memory does not grow with
+    the size of the file.
+    Errors are printed as they are found, and the items in error are left
+    out of the show. The command totals and the number of errors are
+    printed once the file has been read to the end.
+    Iterating gives (index, slide_list), as iter_compiled_blocks().
+    """
+    def __init__(self, text_file_path, max_slide, window=stream_window):
+        self.text_file_path = text_file_path
+        self.max_slide = max_slide
+        self.queue = queue.Queue(maxsize=max(1, window))
+        self.totals = {"slide": 0, "music": 0, "pause": 0, "language": 0}
+        self.error_count = 0
+        self.thread = threading.Thread(target=self.parse)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def parse(self):
+        """Parse the file, blocking while the window is full."""
+        errors = []
+        text_file = os.path.basename(self.text_file_path)
+        try:
+            for block in iter_compiled_blocks(
+                    iter_text_file(self.text_file_path), self.max_slide,
+                    language_code_dict, errors, self.totals):
+                if errors:
+                    print_errors(errors, text_file)
+                    self.error_count += len(errors)
+                    del errors[:]
+                self.queue.put(block)
+            if errors:
+                print_errors(errors, text_file)
+                self.error_count += len(errors)
+        finally:
+            # Marks the end of the file.
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                self.report()
+                return
+            yield block
+
+    def report(self):
+        """Print the totals, as printed for a control file read up front."""
+        text_file = os.path.basename(self.text_file_path)
+        print("Total slides displayed: {}".format(self.totals["slide"]))
+        print("Total music files played: {}".format(self.totals["music"]))
+        print("Total Pause commands: {}".format(self.totals["pause"]))
+        print("Total Language commands: {}".format(self.totals["language"]))
+        print("{} error(s) found in {}".format(self.error_count, text_file))
+
+
+def get_slide_show_filename(slide_data_list):
+    """
+    Get the path and filename for the presentation.
+    The path is expected to not be supplied.
+    The current working directory is used as a path.
+    Be able to accept whitespace and uppercase.
+    Skip comment lines and blank lines.
+    """
+    for item in slide_data_list:
+        # Ignore blank and comment lines
+        if len(item) == 0:
+            continue
+        if len(item) > 0 and item[0] == "#":
+            continue
+
+        if ("slide_show_file" in item and ":" in item and "[" in item and
+             "]" in item):
+            temp = item.strip(' \t\n\r[]')
+            filename = temp.split(":")[1].strip()
+            #print("|" + filename + "|")
+            if filename == "":
+                print("No file name supplied for [slide_show_file: ].")
+                sys.exit("Exiting...")
+            filename_path = "{}{}{}".format(os.getcwd(), os.sep, filename)
+            # Test if file can be opened. Return file path and name if it can...
+            try:
+                with open(filename_path,"r") as f:
+                    return filename, filename_path
+            except FileNotFoundError as e:
+                print("Attempted to open the slide presentation file.")
+                print("FileNotFoundError: {}".format(e.strerror))
+                print("The path or file is invalid: {}".format(e.filename))
+                sys.exit("Exiting...")
+
+    print("[slide_show_file: ] command not found." )
+    sys.exit("Exiting...")
+
+
+def compile_control(slide_data_list, max_slide, language_code_dict):
+    """
+    Check the commands and build the control dictionary in a single pass
+    over the lines of the text/control file.
+    The control dictionary has an integer key for each slide displayed.
+    For each slide in the dictionary, use lists within lists.
+    Each list is the key, value and the line number it came from...
+    [['slide', 1, 97], ['en', 'This is slide 1', 99], ['pause', 2, 101]...] 
+    All errors are collected rather than stopping at the first.
+    Return control_dict, a dictionary with the count of each command and a
+    list of errors. Each error is [line number, line, message].
+    """
+    totals = {"slide": 0, "music": 0, "pause": 0, "language": 0}
+    errors = []
+    control_dict = dict(iter_compiled_blocks(slide_data_list, max_slide,
+                                             language_code_dict, errors,
+                                             totals))
+    return control_dict, totals, errors
+
+
+def iter_compiled_blocks(slide_data_list, max_slide, language_code_dict,
+                         errors, totals):
+    """
+    Check the commands and compile the lines of the text/control file, which
+    may be any iterable of lines, one slide block at a time.
+    Yield (index, slide_list) as each slide block is completed, where index
+    counts the slides displayed from 0.
+    A paragraph of text may span multiple lines. A blank line or a command 
+    terminates the paragraph.
+    Commands checked:
+    [slide:x] x is an integer from 1 to max_slide. If max_slide is None it
+    is checked later with check_slide_range().
+    [music:x] x is a file that exists with a .mp3 or .wav extension.
+    [pause:x] x is a float that is not negative.
+    [language:x] x is in language_code_dict. It becomes the language code.
+    [cue:x] x is the time the slide block starts, in seconds from the start
+    of the show, as seconds, m:s or h:m:s. Used in timeline mode.
+    Items in error are left out. Each error is appended to the errors list
+    as [line number, line, message] and the count of each command is kept
+    in the totals dictionary.
+    """
+    slide_list = None
+    language_code = default_language_code
+    text_list = []
+    text_line_number = 0
+
+    for line_number, item in enumerate(slide_data_list, 1):
+        # Clear spaces from front and rear of line
+        item = item.strip(' \t\n\r')
+
+        # Text lines. Ignore comment lines. Collect the lines of a paragraph.
+        if len(item) > 0 and item[0] != "[":
+            if item[0] == "#":
+                continue
+            if not text_list:
+                text_line_number = line_number
+            text_list.append(item)
+            continue
+
+        # A blank line or a command terminates the paragraph.
+        if text_list:
+            if slide_list is None:
+                errors.append([text_line_number, text_list[0],
+                               "Text is before the first [slide:] command"])
+            else:
+                slide_list.append([language_code, " ".join(text_list),
+                                   text_line_number])
+            text_list = []
+
+        if len(item) == 0 or "]" not in item or ":" not in item:
+            # Blank line, or junked command.
+            continue
+
+        temp = item.strip(' \t\n\r[]')
+        keyword, value = temp.split(":", 1)
+        keyword = keyword.strip().lower()
+        value = value.strip()
+
+        if keyword == "slide":
+            try:
+                slide_number = int(value)
+            except ValueError:
+                errors.append([line_number, item, 
+                               "Slide number {} is not an integer"
+                               .format(value)])
+                continue
+            if max_slide is not None and slide_number > max_slide:
+                errors.append([line_number, item, 
+                               "Slide number {} exceeds total slides of {}"
+                               .format(slide_number, max_slide)])
+                continue
+            if slide_number < 1:
+                errors.append([line_number, item, 
+                               "Slide number {} is less than first slide "
+                               "number of 1.".format(slide_number)])
+                continue
+            # The previous slide block is complete. Start the list for the 
+            # next slide displayed.
+            if slide_list is not None:
+                yield totals["slide"] - 1, slide_list
+            slide_list = [['slide', slide_number, line_number]]
+            totals["slide"] += 1
+
+        elif keyword == "music":
+            # Music packed in the audio archive does not need its file.
+            if not archived_music(value) and not os.path.isfile(value):
+                errors.append([line_number, item, 
+                               "Music file {} is not found".format(value)])
+                continue
+            if value.split(".")[-1].lower() not in ("mp3", "wav"):
+                errors.append([line_number, item, 
+                               "Music file {} does not have .mp3 or .wav "
+                               "extension".format(value)])
+                continue
+            if slide_list is None:
+                errors.append([line_number, item, 
+                               "Music is before the first [slide:] command"])
+                continue
+            slide_list.append(['music', value, line_number])
+            totals["music"] += 1
+
+        elif keyword == "pause":
+            try:
+                pause_value = float(value)
+            except ValueError:
+                errors.append([line_number, item, 
+                               "Pause value {} is not a float".format(value)])
+                continue
+            if pause_value < 0:
+                errors.append([line_number, item, 
+                               "Pause {} is negative value."
+                               .format(pause_value)])
+                continue
+            if slide_list is None:
+                errors.append([line_number, item, 
+                               "Pause is before the first [slide:] command"])
+                continue
+            slide_list.append(['pause', pause_value, line_number])
+            totals["pause"] += 1
+
+        elif keyword == "language":
+            # Convert to language code: 'French' becomes 'fr'
+            # All use two letter code en, fr, etc., except chinese zh-TW, 
+            # zh-CN.
+            try:
+                language_code = language_code_dict[value.lower()]
+            except KeyError:
+                errors.append([line_number, item, 
+                               "Language of '{}' is not valid".format(value)])
+                continue
+            totals["language"] += 1
+
+        elif keyword == "cue":
+            try:
+                cue_value = parse_clock(value)
+            except ValueError:
+                errors.append([line_number, item, 
+                               "Cue time {} is not seconds, m:s or h:m:s"
+                               .format(value)])
+                continue
+            if cue_value < 0:
+                errors.append([line_number, item, 
+                               "Cue {} is negative value.".format(value)])
+                continue
+            if slide_list is None:
+                errors.append([line_number, item, 
+                               "Cue is before the first [slide:] command"])
+                continue
+            if any(entry[0] == "cue" for entry in slide_list):
+                errors.append([line_number, item, 
+                               "Slide block has more than one cue"])
+                continue
+            slide_list.append(['cue', cue_value, line_number])
+
+        # Any other command, including [slide_show_file:], is ignored.
+
+    # The last paragraph may not be followed by a blank line.
+    if text_list:
+        if slide_list is None:
+            errors.append([text_line_number, text_list[0],
+                           "Text is before the first [slide:] command"])
+        else:
+            slide_list.append([language_code, " ".join(text_list),
+                               text_line_number])
+    if slide_list is not None:
+        yield totals["slide"] - 1, slide_list
+
+
+def check_slide_range(control_dict, max_slide):
+    """
+    Check the slide numbers in the control_dict do not exceed the total
+    slides in the presentation. Return a list of errors.
+    """
+    errors = []
+    for i in range(len(control_dict)):
+        key, slide_number, line_number = control_dict[i][0]
+        if slide_number > max_slide:
+            errors.append([line_number, "[slide:{}]".format(slide_number),
+                           "Slide number {} exceeds total slides of {}"
+                           .format(slide_number, max_slide)])
+    return errors
+
+
+def print_errors(errors, text_file):
+    """
+    Print each error found in the text/control file, with the line number
+    and the line.
+    """
+    for line_number, item, message in errors:
+        print("\nError in file {} at line number: {}"
+              .format(text_file, line_number))
+        print("{}".format(item))
+        print(message)
+    print("\n{} error(s) found in {}".format(len(errors), text_file))
+
+
+#------------------------------------------------------------------------------
+#   Compiled presentation plan
+#------------------------------------------------------------------------------
+# The plan is written next to the text/control file after it has been checked
+# and compiled. On the next launch, if the text/control file, the Impress
+# file and the music files are unchanged, the plan is loaded and the checks
+# are skipped. Layout, all little-endian:
+#   header
+#   string table: (offset, length) for each string, then the utf-8 data
+#   op stream: one fixed size record per control item
+#   assets: (string index, sha256) for each music file
+# String 0 is the Impress file name.
+plan_magic = b"GTPLAN\0\0"
+plan_version = 1
+plan_header = struct.Struct("<8sI32s32sIIIIIIII")
+plan_string = struct.Struct("<II")
+# opcode, slide block, line number, arg1, arg2, value
+plan_op = struct.Struct("<BIIIId")
+plan_asset = struct.Struct("<I32s")
+OP_SLIDE, OP_MUSIC, OP_PAUSE, OP_TEXT, OP_CUE = range(5)
+
+
+def plan_path(text_file_path):
+    """Return the path of the compiled plan for a text/control file."""
+    return os.path.splitext(text_file_path)[0] + ".gtplan"
+
+
+def file_hash(file_path):
+    """Return the sha256 digest of a file."""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
+
+
+def music_hash(file_name):
+    """
+    Return the hash of a music file for the plan. Music packed in the 
+    audio archive is played from there, so it is recorded by its archive 
+    id and the file is not read.
+    """
+    if archived_music(file_name):
+        return music_id(file_name)
+    return file_hash(file_name)
+
+
+def write_plan(file_path, control_hash, impress_file, total_slide,
+               control_dict, totals):
+    """
+    Write the compiled control_dict to the plan file. The plan is keyed by
+    the hash of the text/control file and of the Impress file. Music files
+    are recorded with their music_hash(). Written to a temporary file and 
+    renamed.
+    """
+    strings = [impress_file]
+    string_index = {impress_file: 0}
+    assets = []
+    asset_index = {}
+
+    def add_string(string):
+        if string not in string_index:
+            string_index[string] = len(strings)
+            strings.append(string)
+        return string_index[string]
+
+    ops = []
+    for block in range(len(control_dict)):
+        for key, value, line_number in control_dict[block]:
+            if key == "slide":
+                ops.append((OP_SLIDE, block, line_number, value, 0, 0.0))
+            elif key == "pause":
+                ops.append((OP_PAUSE, block, line_number, 0, 0, value))
+            elif key == "cue":
+                ops.append((OP_CUE, block, line_number, 0, 0, value))
+            elif key == "music":
+                if value not in asset_index:
+                    asset_index[value] = len(assets)
+                    assets.append((add_string(value), music_hash(value)))
+                ops.append((OP_MUSIC, block, line_number, add_string(value),
+                            asset_index[value], 0.0))
+            else:
+                ops.append((OP_TEXT, block, line_number, add_string(key),
+                            add_string(value), 0.0))
+
+    encoded = [string.encode("utf-8") for string in strings]
+    data = bytearray()
+    data += plan_header.pack(plan_magic, plan_version, control_hash,
+                             file_hash(impress_file), total_slide,
+                             totals["slide"], totals["music"],
+                             totals["pause"], totals["language"],
+                             len(encoded), len(ops), len(assets))
+    offset = 0
+    for string in encoded:
+        data += plan_string.pack(offset, len(string))
+        offset += len(string)
+    for string in encoded:
+        data += string
+    for op in ops:
+        data += plan_op.pack(*op)
+    for asset in assets:
+        data += plan_asset.pack(*asset)
+
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, file_path)
+
+
+def load_plan(file_path, control_hash):
+    """
+    Memory-map the plan file and rebuild the control_dict from it.
+    Return None if there is no plan, it is truncated or corrupt, or it is
+    out of date: the text/control file, the Impress file or a music file
+    has changed. The caller then compiles the text/control file again.
+    Otherwise return impress_file, total_slide, control_dict and totals.
+    """
+    try:
+        f = open(file_path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file.
+            return None
+    with buf:
+        try:
+            return read_plan(buf, control_hash)
+        except (struct.error, UnicodeDecodeError, IndexError, ValueError):
+            # E.g. a plan left half written.
+            return None
+
+
+def read_plan(buf, control_hash):
+    """
+    Rebuild the plan from the buffer, for load_plan(). Return None if the
+    plan is out of date or its counts do not match the size of the buffer.
+    May raise struct.error, UnicodeDecodeError, IndexError or ValueError
+    if the plan is corrupt.
+    """
+    if len(buf) < plan_header.size:
+        return None
+    (magic, version, plan_control_hash, impress_hash, total_slide,
+     slide_total, music_total, pause_total, language_total,
+     string_count, op_count, asset_count) = plan_header.unpack_from(buf)
+    if (magic != plan_magic or version != plan_version or
+            plan_control_hash != control_hash):
+        return None
+
+    offset = plan_header.size
+    data_offset = offset + string_count * plan_string.size
+    if data_offset > len(buf):
+        return None
+    strings = []
+    end = data_offset
+    for i in range(string_count):
+        start, length = plan_string.unpack_from(buf, offset)
+        start += data_offset
+        end = start + length
+        if end > len(buf):
+            return None
+        strings.append(buf[start:end].decode("utf-8"))
+        offset += plan_string.size
+    offset = end
+    if (offset + op_count * plan_op.size + asset_count * plan_asset.size
+            != len(buf)):
+        return None
+
+    impress_file = strings[0]
+    try:
+        if file_hash(impress_file) != impress_hash:
+            return None
+    except FileNotFoundError:
+        return None
+
+    control_dict = {}
+    for i in range(op_count):
+        opcode, block, line_number, arg1, arg2, value = \
+            plan_op.unpack_from(buf, offset)
+        offset += plan_op.size
+        if opcode == OP_SLIDE:
+            item = ['slide', arg1, line_number]
+        elif opcode == OP_PAUSE:
+            item = ['pause', value, line_number]
+        elif opcode == OP_CUE:
+            item = ['cue', value, line_number]
+        elif opcode == OP_MUSIC:
+            item = ['music', strings[arg1], line_number]
+        else:
+            item = [strings[arg1], strings[arg2], line_number]
+        control_dict.setdefault(block, []).append(item)
+    if sorted(control_dict) != list(range(len(control_dict))):
+        raise ValueError("Slide blocks are not numbered in order")
+
+    for i in range(asset_count):
+        name_index, asset_hash = plan_asset.unpack_from(buf, offset)
+        offset += plan_asset.size
+        try:
+            if music_hash(strings[name_index]) != asset_hash:
+                return None
+        except FileNotFoundError:
+            return None
+
+    totals = {"slide": slide_total, "music": music_total,
+              "pause": pause_total, "language": language_total}
+    return impress_file, total_slide, control_dict, totals
+
+
+#------------------------------------------------------------------------------
+#   Watch mode
+#------------------------------------------------------------------------------
+def block_hash(slide_list):
+    """Return a hash of the keys and values of a slide block."""
+    data = json.dumps([[item[0], item[1]] for item in slide_list])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def paragraph_set(control_dict):
+    """Return the set of (language, text) of all the paragraphs."""
+    return set((item[0], item[1]) for slide_list in control_dict.values()
+               for item in slide_list if is_text_item(item[0]))
+
+
+class LivePlan:
+    """
+    A control_dict that can be replaced while the show is presenting.
+    Iterating gives (index, slide_list) like a BlockStream, each block 
+    being read from the current plan when the show reaches it.
+    The show keeps the item it is presenting in current[0]. When the plan
+    is replaced the show continues after that item, from the new plan. The
+    items it has read ahead from the old plan are dropped, by setting the
+    seek_event. If blocks were added or removed before it, the presenting 
+    block is found in the new plan by its hash.
+    The show can be moved to any block and paragraph with seek(). The 
+    slide_blocks of the plan and presenting() give the positions to seek
+    to.
+    """
+    def __init__(self, control_dict):
+        self.lock = threading.Lock()
+        self.control_dict = control_dict
+        self.hashes = [block_hash(control_dict[i])
+                       for i in range(len(control_dict))]
+        self.slide_blocks, self.item_index = build_index(control_dict)
+        self.position = -1
+        # Items to skip at the start of the next block, after a seek.
+        self.offset = 0
+        self.seek_event = threading.Event()
+        self.current = [None]
+        # The item presenting when the plan was replaced, and its position
+        # in the new plan.
+        self.moved = (None, None)
+
+    def locate(self, item):
+        """Return the (block, offset) of a plan item, or None."""
+        if item is None:
+            return None
+        if item is self.moved[0]:
+            return self.moved[1]
+        position = self.item_index.get(id(item))
+        if position is None:
+            return None
+        index, offset = position
+        if self.control_dict[index][offset] is not item:
+            return None
+        return position
+
+    def presenting(self):
+        """Return the (block, offset) of the item presenting, or None."""
+        with self.lock:
+            return self.locate(self.current[0])
+
+    def update(self, control_dict):
+        """
+        Replace the plan. Return the number of blocks that are new or 
+        changed.
+        """
+        hashes = [block_hash(control_dict[i]) 
+                  for i in range(len(control_dict))]
+        slide_blocks, item_index = build_index(control_dict)
+        reread = False
+        with self.lock:
+            changed = len(set(hashes) - set(self.hashes))
+            presenting = self.locate(self.current[0])
+            if presenting is not None and hashes:
+                # Read on from the item after the one presenting.
+                index, offset = presenting
+                matches = [i for i, h in enumerate(hashes) 
+                           if h == self.hashes[index]]
+                if matches:
+                    index = min(matches, key=lambda i: abs(i - index))
+                else:
+                    # The presenting block itself was changed.
+                    index = min(index, len(hashes) - 1)
+                self.moved = (self.current[0], (index, offset))
+                self.position = index - 1
+                self.offset = offset + 1
+                reread = True
+            elif 0 <= self.position < len(self.hashes):
+                current = self.hashes[self.position]
+                matches = [i for i, h in enumerate(hashes) if h == current]
+                if matches:
+                    self.position = min(matches,
+                                        key=lambda i: abs(i - self.position))
+            self.control_dict = control_dict
+            self.hashes = hashes
+            self.slide_blocks = slide_blocks
+            self.item_index = item_index
+        if reread:
+            self.seek_event.set()
+        return changed
+
+    def seek(self, index, offset=0):
+        """
+        Move the show to item offset of block index. The seek_event is set
+        for the show to drop the items it has read ahead.
+        """
+        with self.lock:
+            self.position = index - 1
+            self.offset = offset
+        self.seek_event.set()
+
+    def __iter__(self):
+        while True:
+            with self.lock:
+                self.position += 1
+                if self.position >= len(self.control_dict):
+                    return
+                index = self.position
+                slide_list = self.control_dict[index][self.offset:]
+                self.offset = 0
+            yield index, slide_list
+
+
+def build_index(control_dict):
+    """
+    Index the plan for random access. Return a dictionary from slide 
+    number to the list of blocks that display the slide, and a dictionary
+    from the id() of each item to its (block, offset in block). Items are
+    keyed by identity, not line number, as the line numbers change when 
+    the control file is edited.
+    """
+    slide_blocks = {}
+    item_index = {}
+    for index in range(len(control_dict)):
+        for offset, item in enumerate(control_dict[index]):
+            if item[0] == "slide":
+                slide_blocks.setdefault(item[1], []).append(index)
+            item_index[id(item)] = (index, offset)
+    return slide_blocks, item_index
+
+
+class KeyboardControl:
+    """
+    Control the show from the keyboard. Commands are read from the terminal
+    in a background thread, one per line:
+        n       next slide block
+        p       previous slide block
+        g N, N  go to slide N
+        r       replay the paragraph
+        q       end the show
+    A seek moves the live plan, stops the audio playing and submits the
+    speech at the destination for fetching straight away. The engine 
+    reports the time from the seek to the first audio.
+    """
+    def __init__(self, live_plan, engine, prefetcher, stdin=sys.stdin):
+        """
+        The item being presented is read from the live plan.
+        """
+        self.live_plan = live_plan
+        self.engine = engine
+        self.prefetcher = prefetcher
+        self.stdin = stdin
+        print("Keyboard: n next, p previous, g N go to slide N, r replay, "
+              "q quit. Then Enter.")
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        for line in self.stdin:
+            words = line.split()
+            if not words:
+                continue
+            try:
+                index, offset = self.target(words)
+            except ValueError as e:
+                print(e)
+                continue
+            self.seek(index, offset)
+
+    def position(self):
+        """Return the (block, offset) of the item being presented."""
+        position = self.live_plan.presenting()
+        if position is not None:
+            return position
+        return max(self.live_plan.position, 0), 0
+
+    def target(self, words):
+        """
+        Return the (block, offset) to seek to for a command. Raise 
+        ValueError if the command is not understood.
+        """
+        index, offset = self.position()
+        command = words[0].lower()
+        if command == "n":
+            return index + 1, 0
+        if command == "p":
+            return max(index - 1, 0), 0
+        if command == "r":
+            return index, offset
+        if command == "q":
+            return len(self.live_plan.control_dict), 0
+        if command == "g":
+            words = words[1:]
+        try:
+            slide = int(words[0])
+        except (IndexError, ValueError):
+            raise ValueError("Unknown command: {}".format(" ".join(words)))
+        blocks = self.live_plan.slide_blocks.get(slide)
+        if not blocks:
+            raise ValueError("Slide {} is not in the show.".format(slide))
+        # The next time the slide is shown, else the first.
+        later = [block for block in blocks if block >= index]
+        return (later or blocks)[0], 0
+
+    def seek(self, index, offset):
+        """Move the show, warm the destination and stop the audio."""
+        self.engine.seek_time = time.monotonic()
+        tracer.instant("seek", "show", block=index, offset=offset)
+        self.warm(index, offset)
+        self.live_plan.seek(index, offset)
+        self.engine.stop()
+
+    def warm(self, index, offset):
+        """Submit the speech of the first paragraphs at the destination."""
+        control_dict = self.live_plan.control_dict
+        remaining = max(self.prefetcher.depth, 1)
+        while remaining > 0 and index < len(control_dict):
+            for item in control_dict[index][offset:]:
+                if remaining > 0 and is_text_item(item[0]):
+                    self.prefetcher.submit(item)
+                    remaining -= 1
+            index += 1
+            offset = 0
+
+
+class ControlWatcher:
+    """
+    Watch the text/control file in a background thread. When it changes, 
+    compile it and diff the slide blocks and paragraphs against the live
+    plan. Only the paragraphs with a new (language, text) are synthesized,
+    in the background, before the live plan is updated. The compiled plan
+    file is rewritten.
+    If the changed file has errors they are printed and the show carries
+    on with the plan it has.
+    """
+    def __init__(self, text_file_path, impress_file, total_slide, live_plan,
+                 cache, backend, interval=watch_interval):
+        self.text_file_path = text_file_path
+        self.impress_file = impress_file
+        self.total_slide = total_slide
+        self.live_plan = live_plan
+        self.cache = cache
+        self.backend = backend
+        self.interval = interval
+        self.stat = self.file_stat()
+        self.control_hash = file_hash(text_file_path)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def file_stat(self):
+        try:
+            stat = os.stat(self.text_file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            stat = self.file_stat()
+            if stat is None or stat == self.stat:
+                continue
+            self.stat = stat
+            try:
+                self.reload()
+            except Exception as e:
+                # Keep watching. The show goes on with the plan it has.
+                print("Reload of {} failed: {}"
+                      .format(self.text_file_path, e))
+
+    def reload(self):
+        """Compile the changed file and update the live plan."""
+        control_hash = file_hash(self.text_file_path)
+        if control_hash == self.control_hash:
+            return
+        self.control_hash = control_hash
+        slide_data_list = read_text_file(self.text_file_path)
+        control_dict, totals, errors = compile_control(
+                slide_data_list, self.total_slide, language_code_dict)
+        if errors:
+            print_errors(errors, os.path.basename(self.text_file_path))
+            print("Changes not loaded. Carrying on with the previous plan.")
+            return
+
+        # Synthesize the new paragraphs before the show reaches them.
+        new_paragraphs = (paragraph_set(control_dict) - 
+                          paragraph_set(self.live_plan.control_dict))
+        prefetcher = Prefetcher(self.cache, 0, backend=self.backend)
+        for language, text in new_paragraphs:
+            prefetcher.submit([language, text, 0])
+        prefetcher.shutdown(wait=True)
+
+        changed = self.live_plan.update(control_dict)
+        print("Reloaded {}: {} of {} slide blocks changed, {} paragraphs "
+              "synthesized.".format(os.path.basename(self.text_file_path),
+                                    changed, len(control_dict),
+                                    len(new_paragraphs)))
+        write_plan(plan_path(self.text_file_path), control_hash, 
+                   self.impress_file, self.total_slide, control_dict, totals)
+
+    def stop(self):
+        self.stopped.set()
+
+
+#------------------------------------------------------------------------------
+#   Text chunking
+#------------------------------------------------------------------------------
+# Split after sentence and clause punctuation. Full width punctuation used by
+# chinese and japanese is not followed by a space.
+sentence_pattern = re.compile(r"(?<=[.!?])\s+|(?<=[\u3002\uff01\uff1f])\s*")
+clause_pattern = re.compile(r"(?<=[,;:])\s+|(?<=[\u3001\uff0c\uff1b\uff1a])\s*")
+word_pattern = re.compile(r"\s+")
+
+
+def split_text(text, language, limit=tts_char_limit):
+    """
+    Split a paragraph of text into chunks of no more than limit characters.
+    Sentences are packed together up to the limit. A sentence that is too
+    long is split at clauses, then at words. A word or, for languages 
+    written without spaces, a run of characters that is still too long is
+    cut at the limit, on a character boundary. In those languages the cut
+    is also kept out of latin words and away from thai and lao vowels 
+    written before their consonant.
+    Pieces packed into a chunk keep the spacing they had in the text.
+    Returns a list of chunks. Short text is returned as a single chunk.
+    """
+    text = " ".join(text.split())
+    if not text:
+        return []
+    return _split_chunks(text, limit,
+                         [sentence_pattern, clause_pattern, word_pattern],
+                         language in unspaced_languages)
+
+
+def _split_chunks(text, limit, patterns, unspaced=False):
+    """
+    Split text with the first pattern and pack the pieces into chunks up to
+    the limit. Pieces over the limit are split with the next pattern. With 
+    no patterns left the text is cut at the limit.
+    """
+    if len(text) <= limit:
+        return [text]
+    if not patterns:
+        return _cut_text(text, limit, unspaced)
+    chunks = []
+    chunk = ""
+    # The separator matched before each piece, kept when packing.
+    separator = ""
+    start = 0
+    pieces = []
+    for match in patterns[0].finditer(text):
+        pieces.append((separator, text[start:match.start()]))
+        separator = match.group()
+        start = match.end()
+    pieces.append((separator, text[start:]))
+    for separator, piece in pieces:
+        if not piece:
+            continue
+        if len(piece) > limit:
+            if chunk:
+                chunks.append(chunk)
+                chunk = ""
+            chunks.extend(_split_chunks(piece, limit, patterns[1:],
+                                        unspaced))
+        elif not chunk:
+            chunk = piece
+        elif len(chunk) + len(separator) + len(piece) <= limit:
+            chunk = chunk + separator + piece
+        else:
+            chunks.append(chunk)
+            chunk = piece
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _cut_text(text, limit, unspaced=False):
+    """
+    Cut text into pieces of up to limit characters. Each cut is moved back
+    so it does not separate a combining mark, e.g. a thai vowel or tone 
+    mark, from the character it is written on. If unspaced, it is also
+    moved out of latin words and away from leading vowels.
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = limit
+        while cut > 0 and _joins_previous(text[cut], text[cut - 1], 
+                                          unspaced):
+            cut -= 1
+        if cut == 0:
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:]
+    pieces.append(text)
+    return pieces
+
+
+def _joins_previous(char, previous, unspaced=False):
+    """
+    Return True if char is part of the same grapheme cluster as the 
+    character before it. If unspaced, also if the two are letters of a
+    latin word, or the one before is a thai or lao leading vowel.
+    """
+    if unicodedata.category(char) in ("Mn", "Mc", "Me"):
+        return True
+    # Thai and Lao sara am, zero width joiner and skin tone modifiers.
+    if char in "\u0e33\u0eb3\u200d" or "\U0001f3fb" <= char <= "\U0001f3ff":
+        return True
+    # After a joiner or a khmer coeng, which puts the next consonant 
+    # below.
+    if previous in "\u200d\u17d2":
+        return True
+    if not unspaced:
+        return False
+    if "\u0e40" <= previous <= "\u0e44" or "\u0ec0" <= previous <= "\u0ec4":
+        return True
+    return (previous < "\x80" and char < "\x80" and previous.isalnum() and
+            char.isalnum())
+
+
+#------------------------------------------------------------------------------
+#   HTTP connection pool
+#------------------------------------------------------------------------------
+class HTTPPool:
+    """
+    Pool of keep-alive http and https connections shared by all the speech
+    fetching, so the TLS handshake is not repeated for every paragraph.
+    At most pool_size connections per host are in use at once. Idle 
+    connections are kept for reuse. A connection is closed after it has
+    carried max_requests requests, or if the server asks for it to close.
+    Counts the requests and the connections opened to give the reuse rate.
+    """
+    def __init__(self, pool_size=http_pool_size, timeout=http_timeout,
+                 max_requests=http_max_requests):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_requests = max_requests
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        # (scheme, host, port): [connection, requests carried], idle only.
+        self.idle = collections.defaultdict(list)
+        self.slots = {}
+
+    def get(self, url, headers=None):
+        """
+        Send a GET request. Return the status, reason and body.
+        Raises OSError or http.client.HTTPException if the request fails.
+        """
+        with self.open(url, headers) as response:
+            body = response.read()
+        return response.status, response.reason, body
+
+    @contextlib.contextmanager
+    def open(self, url, headers=None):
+        """
+        Send a GET request and return the response, to read the body from
+        as it arrives. The connection is held until the with block ends. It
+        is returned to the pool if the body was read to the end, else it is
+        closed.
+        Raises OSError or http.client.HTTPException if the request fails.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = path + "?" + parts.query
+        host_key = (parts.scheme, parts.hostname, parts.port)
+        with self.lock:
+            slot = self.slots.get(host_key)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.pool_size)
+                self.slots[host_key] = slot
+        with slot:
+            entry = self.acquire(host_key)
+            reused = entry[1] > 0
+            try:
+                response = self.request(entry, path, headers)
+            except (OSError, http.client.HTTPException):
+                entry[0].close()
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection. Retry 
+                # once on a new connection.
+                entry = self.connect(host_key)
+                try:
+                    response = self.request(entry, path, headers)
+                except (OSError, http.client.HTTPException):
+                    entry[0].close()
+                    raise
+            try:
+                yield response
+            except BaseException:
+                entry[0].close()
+                raise
+            if (response.will_close or not response.isclosed() or 
+                    entry[1] >= self.max_requests):
+                entry[0].close()
+            else:
+                with self.lock:
+                    self.idle[host_key].append(entry)
+
+    def acquire(self, host_key):
+        """Return an idle connection to the host, or a new one."""
+        with self.lock:
+            if self.idle[host_key]:
+                return self.idle[host_key].pop()
+        return self.connect(host_key)
+
+    def connect(self, host_key):
+        """Open a new connection to the host."""
+        scheme, host, port = host_key
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(host, port,
+                                                     timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(host, port,
+                                                    timeout=self.timeout)
+        with self.lock:
+            self.connections += 1
+        return [connection, 0]
+
+    def request(self, entry, path, headers):
+        """Send the request on the connection and return the response."""
+        with self.lock:
+            self.requests += 1
+        entry[1] += 1
+        entry[0].request("GET", path, headers=headers or {})
+        return entry[0].getresponse()
+
+    def reuse_rate(self):
+        """Return the fraction of requests sent on a reused connection."""
+        if self.requests == 0:
+            return 0.0
+        return max(self.requests - self.connections, 0) / self.requests
+
+    def report(self):
+        """Return a line summarizing the connection reuse."""
+        return ("HTTP pool: {} requests, {} connections opened, "
+                "{:.0%} reused".format(self.requests, self.connections,
+                                       self.reuse_rate()))
+
+    def close(self):
+        """Close the idle connections."""
+        with self.lock:
+            for entries in self.idle.values():
+                for connection, requests in entries:
+                    connection.close()
+            self.idle.clear()
+
+
+#------------------------------------------------------------------------------
+#   Fetch rate limiting
+#------------------------------------------------------------------------------
+class FetchLimiter:
+    """
+    Limits the requests sent to a text to speech server, so a burst of 
+    fetching, e.g. a preflight or a fleet of shows starting, does not get
+    throttled. A token bucket limits the rate and an adaptive limit the
+    requests in flight. The limit is raised additively while answers come
+    back within target_latency, and halved when the server throttles or
+    slows down, at most once per target_latency.
+    Counts the waits, the throttled and slow answers and the highest limit.
+    """
+    def __init__(self, rate, burst, concurrency, max_concurrency,
+                 target_latency):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.condition = threading.Condition()
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.limit = float(min(concurrency, max_concurrency))
+        self.in_flight = 0
+        self.decreased = 0.0
+        self.waits = 0
+        self.throttled = 0
+        self.slow = 0
+        self.peak = self.limit
+
+    def refill(self, now):
+        """Add the tokens earned since the last refill."""
+        self.tokens = min(self.burst, 
+                          self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def acquire(self, deadline=None):
+        """
+        Wait for a token and a free slot, then take them. Return False if
+        the deadline passes first.
+        """
+        with self.condition:
+            waited = False
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if self.in_flight < int(self.limit) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    if waited:
+                        self.waits += 1
+                    return True
+                if deadline is not None and now >= deadline:
+                    return False
+                # Wake for the next token, or when a slot is released.
+                timeout = None
+                if self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                if deadline is not None:
+                    timeout = min(timeout or deadline - now, deadline - now)
+                waited = True
+                self.condition.wait(timeout)
+
+    def release(self, latency=None, throttled=False):
+        """
+        Free the slot taken by acquire() and adjust the limit. latency is
+        the seconds taken by a successful request, or None if it failed.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                # Stop the burst as well.
+                self.tokens = 0.0
+                self.decrease()
+            elif latency is not None:
+                if latency > self.target_latency:
+                    self.slow += 1
+                    self.decrease()
+                else:
+                    self.limit = min(self.max_concurrency, 
+                                     self.limit + 1 / self.limit)
+                    self.peak = max(self.peak, self.limit)
+            self.condition.notify_all()
+
+    def decrease(self):
+        """Halve the limit, unless it was halved in the last round."""
+        now = time.monotonic()
+        if now - self.decreased < self.target_latency:
+            return
+        self.decreased = now
+        self.limit = max(1.0, self.limit / 2)
+
+    def report(self):
+        """Return a line summarizing the limiting."""
+        with self.condition:
+            return ("Fetch limit: {} waits, {} throttled, {} slow, "
+                    "concurrency {:.1f} (peak {:.1f})"
+                    .format(self.waits, self.throttled, self.slow,
+                            self.limit, self.peak))
+
+
+#------------------------------------------------------------------------------
+#   Text to speech backends
+#------------------------------------------------------------------------------
+class SynthesisError(Exception):
+    """Raised by a backend when text could not be converted to speech."""
+
+
+class ThrottledError(SynthesisError):
+    """Raised when the server asks for fewer requests, HTTP 429 or 503."""
+
+
+class TTSBackend:
+    """
+    Base class for text to speech backends.
+    synthesize() returns the audio data for the text in the language.
+    name is part of the audio cache key, extension is the audio file type
+    and max_concurrency is the most requests the backend should be sent at
+    the same time. fallback is the backend speech_file() turns to if this
+    one fails, and deadline the seconds it waits for the speech, or None.
+    """
+    name = None
+    extension = "mp3"
+    max_concurrency = 1
+    fallback = None
+    deadline = None
+
+    def synthesize(self, text, language):
+        raise NotImplementedError
+
+    def stream(self, text, language):
+        """
+        Yield the audio data in chunks as it arrives. Backends that can not
+        stream yield it all at once.
+        """
+        yield self.synthesize(text, language)
+
+    def report(self):
+        """Return a line of statistics to print after the show, or ''."""
+        return ""
+
+
+class GoogleBackend(TTSBackend):
+    """
+    Use google translate to do text to speech translation. Requests are sent
+    through a pool of keep-alive connections.
+    """
+    name = "google"
+    extension = "mp3"
+    max_concurrency = 4
+    url = 'https://translate.google.com/translate_tts'
+    user_agent = 'Mozilla'
+
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = HTTPPool()
+        self.pool = pool
+
+    def request(self, text, language):
+        """
+        Return the url and headers of the request for the speech.
+        text = text to be converted to speech
+        language = en is English, fr is French, de is German, etc.
+        """
+        # Build the url string.
+        values = {'tl' : language,
+                  'client' : 'tw-ob',
+                  'ie' : 'UTF-8',
+                  'q' : text }
+        data = urllib.parse.urlencode(values)
+        headers = { 'User-Agent' : self.user_agent }
+        return self.url + "?" + data, headers
+
+    def synthesize(self, text, language):
+        """Return the mp3 data."""
+        return pool_fetch(self.pool, *self.request(text, language))
+
+    def stream(self, text, language):
+        """Yield the mp3 data as it arrives."""
+        return pool_stream(self.pool, *self.request(text, language))
+
+    def report(self):
+        return self.pool.report()
+
+
+class LocalEngineBackend(TTSBackend):
+    """
+    Off-line text to speech with the espeak or pico2wave applications. The
+    engine is run as a subprocess and returns wav data. As it uses the local
+    cpu, one request per core is run at the same time.
+    pico2wave only supports a few languages.
+    """
+    extension = "wav"
+    pico_language_dict = {'en': 'en-GB', 'de': 'de-DE', 'es': 'es-ES',
+                          'fr': 'fr-FR', 'it': 'it-IT'}
+
+    def __init__(self, engine="espeak"):
+        if engine not in ("espeak", "pico"):
+            raise ValueError("Unknown local engine: {}".format(engine))
+        self.name = engine
+        self.max_concurrency = os.cpu_count() or 1
+
+    def synthesize(self, text, language):
+        """Run the engine and return the wav data."""
+        try:
+            if self.name == "espeak":
+                # espeak has a single voice for both chinese languages.
+                voice = language.split("-")[0].lower()
+                result = subprocess.run(
+                        ["espeak", "-v", voice, "--stdout", text],
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        check=True)
+                return result.stdout
+            return self.synthesize_pico(text, language)
+        except FileNotFoundError as e:
+            raise SynthesisError("{} is not installed".format(e.filename))
+        except subprocess.CalledProcessError as e:
+            raise SynthesisError(e.stderr.decode("utf-8", "replace").strip())
+
+    def synthesize_pico(self, text, language):
+        """pico2wave can only write to a file ending in .wav."""
+        try:
+            pico_language = self.pico_language_dict[language]
+        except KeyError:
+            raise SynthesisError("pico does not speak language {}"
+                                 .format(language))
+        fd, wav_path = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        try:
+            subprocess.run(["pico2wave", "-l", pico_language, "-w", wav_path,
+                            text],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           check=True)
+            with open(wav_path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(wav_path)
+
+
+class HTTPBackend(TTSBackend):
+    """
+    Text to speech from a configurable http endpoint. The url has {language}
+    and {text} fields. Used to point at a local stand-in server, to run and
+    benchmark a presentation without going to google.
+    """
+    name = "http"
+    extension = "mp3"
+
+    def __init__(self, url=http_backend_url, max_concurrency=8, pool=None):
+        if pool is None:
+            pool = HTTPPool()
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.pool = pool
+
+    def request(self, text, language):
+        """Return the url of the request for the speech."""
+        return self.url.format(language=urllib.parse.quote(language),
+                               text=urllib.parse.quote(text))
+
+    def synthesize(self, text, language):
+        """Return the audio data from the endpoint."""
+        return pool_fetch(self.pool, self.request(text, language))
+
+    def stream(self, text, language):
+        """Yield the audio data from the endpoint as it arrives."""
+        return pool_stream(self.pool, self.request(text, language))
+
+    def report(self):
+        return self.pool.report()
+
+
+class ResilientBackend(TTSBackend):
+    """
+    Wraps a network backend so a slow or failing server does not stall the
+    show. Each request has until deadline seconds. A failed request is 
+    retried after a jittered backoff. A request with no answer after the
+    95th percentile of the recent latencies is hedged with a duplicate and
+    the first answer is used. Once the deadline passes SynthesisError is
+    raised and speech_file() uses the fallback local engine.
+    Requests are sent within the limits of the FetchLimiter, by default 
+    those in fetch_limits for the backend.
+    Counts the retries, the hedges sent and won and the fallbacks.
+    """
+    def __init__(self, backend, fallback=None, deadline=fetch_deadline,
+                 retries=fetch_retries, hedge=True, limiter=None):
+        if limiter is None:
+            limiter = FetchLimiter(**fetch_limits[backend.name])
+        self.backend = backend
+        self.name = backend.name
+        self.extension = backend.extension
+        self.limiter = limiter
+        self.max_concurrency = limiter.max_concurrency
+        self.fallback = fallback
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge = hedge
+        self.lock = threading.Lock()
+        # Seconds taken by the recent successful requests.
+        self.latencies = collections.deque(maxlen=hedge_window)
+        self.requests = 0
+        self.retried = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.fallbacks = 0
+        # Requests are sent from these threads, so one that is slow can be
+        # left behind when a hedge or the deadline wins.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=4 * self.max_concurrency)
+
+    def hedge_delay(self):
+        """Return the seconds to wait for an answer before hedging."""
+        with self.lock:
+            if len(self.latencies) < hedge_min_samples:
+                return hedge_delay
+            latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+    def backoff(self, attempt):
+        """Return a random delay before the retry, full jitter."""
+        return random.uniform(0, min(retry_backoff_max, 
+                                     retry_backoff * 2 ** (attempt - 1)))
+
+    def timed(self, text, language, deadline):
+        """
+        Fetch the speech within the limits and record how long it took.
+        """
+        if not self.limiter.acquire(deadline):
+            raise SynthesisError("fetch limit")
+        start = time.monotonic()
+        try:
+            data = self.backend.synthesize(text, language)
+        except ThrottledError:
+            self.limiter.release(throttled=True)
+            raise
+        except SynthesisError:
+            self.limiter.release()
+            raise
+        latency = time.monotonic() - start
+        self.limiter.release(latency)
+        with self.lock:
+            self.latencies.append(latency)
+        return data
+
+    def synthesize(self, text, language):
+        """
+        Return the audio data, retrying and hedging until the deadline.
+        Raises SynthesisError if there is no answer by then.
+        """
+        began = time.monotonic()
+        deadline = began + self.deadline
+        with self.lock:
+            self.requests += 1
+        error = None
+        attempts = 0
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+                with self.lock:
+                    self.retried += 1
+            attempts += 1
+            try:
+                return self.attempt(text, language, deadline)
+            except SynthesisError as e:
+                error = e
+                if time.monotonic() >= deadline:
+                    break
+        raise SynthesisError("{} (gave up after {:.1f} s and {} attempts)"
+                             .format(error, time.monotonic() - began,
+                                     attempts))
+
+    def attempt(self, text, language, deadline):
+        """
+        Send the request, and a hedge if it is slow. Return the first audio
+        data to arrive. Raises SynthesisError if the requests fail or the 
+        deadline passes.
+        """
+        futures = [self.executor.submit(self.timed, text, language,
+                                        deadline)]
+        hedge = None
+        hedge_at = time.monotonic() + self.hedge_delay()
+        error = None
+        while futures:
+            now = time.monotonic()
+            if now >= deadline:
+                raise SynthesisError("no answer")
+            if self.hedge and hedge is None:
+                wake = min(hedge_at, deadline)
+            else:
+                wake = deadline
+            done, not_done = concurrent.futures.wait(
+                    futures, timeout=wake - now,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                futures.remove(future)
+                try:
+                    data = future.result()
+                except SynthesisError as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    with self.lock:
+                        self.hedges_won += 1
+                return data
+            if (self.hedge and hedge is None and futures and 
+                    time.monotonic() >= hedge_at):
+                hedge = self.executor.submit(self.timed, text, language,
+                                             deadline)
+                futures.append(hedge)
+                with self.lock:
+                    self.hedges += 1
+        raise error
+
+    def stream(self, text, language):
+        """
+        Yield the audio data as it arrives. A request that fails before its
+        first chunk is retried as in synthesize(). Streams are not hedged.
+        """
+        began = time.monotonic()
+        deadline = began + self.deadline
+        with self.lock:
+            self.requests += 1
+        error = None
+        attempts = 0
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+                with self.lock:
+                    self.retried += 1
+            if not self.limiter.acquire(deadline):
+                error = "fetch limit"
+                break
+            attempts += 1
+            start = time.monotonic()
+            chunks = self.backend.stream(text, language)
+            try:
+                first = next(chunks)
+            except StopIteration:
+                self.limiter.release(time.monotonic() - start)
+                return
+            except ThrottledError as e:
+                self.limiter.release(throttled=True)
+                error = e
+                if time.monotonic() >= deadline:
+                    break
+                continue
+            except SynthesisError as e:
+                self.limiter.release()
+                error = e
+                if time.monotonic() >= deadline:
+                    break
+                continue
+            # The slot is freed at the first chunk. The rest is read as
+            # fast as it is played.
+            self.limiter.release(time.monotonic() - start)
+            yield first
+            yield from chunks
+            return
+        raise SynthesisError("{} (gave up after {:.1f} s and {} attempts)"
+                             .format(error, time.monotonic() - began,
+                                     attempts))
+
+    def report(self):
+        with self.lock:
+            line = ("Speech requests: {} requests, {} retries, {} hedges "
+                    "sent, {} won, {} fallbacks"
+                    .format(self.requests, self.retried, self.hedges,
+                            self.hedges_won, self.fallbacks))
+        line = line + "\n" + self.limiter.report()
+        backend_report = self.backend.report()
+        if backend_report:
+            line = line + "\n" + backend_report
+        return line
+
+
+def pool_fetch(pool, url, headers=None):
+    """
+    Fetch the url through the connection pool and return the body.
+    Raises SynthesisError if the request fails or the status is not 200.
+    """
+    try:
+        status, reason, body = pool.get(url, headers)
+    except (OSError, http.client.HTTPException) as e:
+        raise SynthesisError(e)
+    if status != 200:
+        raise status_error(status, reason)
+    return body
+
+
+def pool_stream(pool, url, headers=None, chunk_size=speech_chunk_bytes):
+    """
+    Fetch the url through the connection pool, yielding the body in chunks
+    of up to chunk_size bytes as they arrive.
+    Raises SynthesisError if the request fails or the status is not 200.
+    """
+    try:
+        with pool.open(url, headers) as response:
+            if response.status != 200:
+                raise status_error(response.status, response.reason)
+            while True:
+                chunk = response.read1(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            # Marks the response complete, so the connection is reused.
+            response.read()
+    except (OSError, http.client.HTTPException) as e:
+        raise SynthesisError(e)
+
+
+def status_error(status, reason):
+    """Return the SynthesisError for an HTTP status other than 200."""
+    message = "HTTP {} {}".format(status, reason)
+    if status == 429 or status == 503:
+        return ThrottledError(message)
+    return SynthesisError(message)
+
+
+def make_backend(name=tts_backend, url=http_backend_url, pool=None,
+                 fallback=None, deadline=fetch_deadline, hedge=True,
+                 limiter=None):
+    """
+    Return the text to speech backend with the name. The google and http 
+    backends use the connection pool. Their requests are retried and hedged
+    until the deadline, then the fallback local engine is used, if named.
+    Requests are sent within the limits of the FetchLimiter, by default
+    those in fetch_limits for the backend.
+    """
+    if name == "google":
+        backend = GoogleBackend(pool)
+    elif name == "http":
+        backend = HTTPBackend(url, pool=pool)
+    else:
+        return LocalEngineBackend(name)
+    if fallback is not None:
+        fallback = LocalEngineBackend(fallback)
+    return ResilientBackend(backend, fallback, deadline, hedge=hedge,
+                            limiter=limiter)
+
+
+def make_speech_stack(args, fallback=None):
+    """
+    Return the audio cache and the text to speech backend set up from the
+    command line: the connection pool, the fetch limits, the deadline and
+    the hedging. The fallback local engine is used, if named.
+    """
+    cache = AudioCache(cache_dir, cache_max_bytes)
+    http_pool = HTTPPool(args.http_pool_size, args.http_timeout,
+                         args.http_max_requests)
+    # Fetch limits given on the command line are for the backend chosen.
+    limiter = None
+    if args.backend in fetch_limits:
+        limits = dict(fetch_limits[args.backend])
+        if args.fetch_rate is not None:
+            limits["rate"] = args.fetch_rate
+        if args.fetch_concurrency is not None:
+            limits["max_concurrency"] = args.fetch_concurrency
+            limits["concurrency"] = min(limits["concurrency"], 
+                                        args.fetch_concurrency)
+        limiter = FetchLimiter(**limits)
+    backend = make_backend(args.backend, args.backend_url, http_pool,
+                           fallback, args.fetch_deadline, not args.no_hedge,
+                           limiter)
+    return cache, backend
+
+
+#------------------------------------------------------------------------------
+#   Audio cache
+#------------------------------------------------------------------------------
+class AudioCache:
+    """
+    Content addressed on-disk cache of the speech audio.
+    Each clip is stored in cache_dir under the sha256 of the backend, the
+    language code and the normalized text. The total size is capped at 
+    max_bytes and the least recently used clips are deleted first.
+    Clips are written to a temporary file then renamed into place, so a
+    partly written clip is never played.
+    Counts the cache hits and misses.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Misses served by a fetch of the same clip already in flight.
+        self.shared = 0
+        # key: StreamingClip still downloading.
+        self.streams = {}
+        self.total_bytes = 0
+        # key: [filename, size]. Ordered least recently used first.
+        self.index = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # key: lock held while the clip is being fetched.
+        self.key_locks = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self.load_index()
+
+    @staticmethod
+    def make_key(text, language, backend=tts_backend):
+        """
+        Return the cache key for a paragraph of text spoken by the named
+        backend. Whitespace is normalized so re-flowing a paragraph in the
+        control file does not cause it to be fetched again.
+        """
+        normalized = " ".join(text.split())
+        data = "{}\0{}\0{}".format(backend, language, normalized)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def load_index(self):
+        """
+        Scan the cache folder. The file modification time is used as the
+        last access time, so the LRU order survives a restart.
+        Left over temporary files from an interrupted write are removed.
+        """
+        entries = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, filename, stat.st_size))
+        for mtime, filename, size in sorted(entries):
+            key = filename.split(".")[0]
+            self.index[key] = [filename, size]
+            self.total_bytes += size
+
+    def path(self, key, count=True):
+        """
+        Return the file path for a key, or None if not in the cache.
+        If count is False the lookup is not counted as a hit or miss.
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.misses += count
+                return None
+            self.hits += count
+            self.index.move_to_end(key)
+        path = os.path.join(self.directory, entry[0])
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Removed behind our back. Treat as a miss.
+            with self.lock:
+                self.index.pop(key, None)
+                self.hits -= count
+                self.misses += count
+            return None
+        return path
 
+    def key_lock(self, key):
+        """Return the lock to hold while fetching the clip for a key."""
+        with self.lock:
+            lock = self.key_locks.get(key)
+            if lock is None:
+                lock = self.key_locks[key] = threading.Lock()
+            return lock
 
-def initialize():
-    """
-    Initialize GObject.threads, Gst, player, loop and bus.
-    Create a fakesink to bury any video.
-    Bus is set up to perfom a call back to def bus_call(bus, message, loop)
-    every time a playbin message is generated.
-    """
-    # Init
-    GObject.threads_init()
-    Gst.init(None)
-    # Instantiate    
-    player = Gst.ElementFactory.make("playbin", 'player')
-    if not player:
-        sys.stderr.write("'playbin' gstreamer plugin missing\n")
-        sys.exit(1)
-    fakesink = Gst.ElementFactory.make("fakesink", "fakesink")
-    player.set_property("video-sink", fakesink)
-
-    # Instantiate the event loop .
-    loop = GObject.MainLoop()
-    # Instantiate and initialize the bus call-back 
-    bus = player.get_bus()
-    bus.add_signal_watch()
-    bus.connect ("message", bus_call, loop)
-
-    return player, loop
-
-
-def play_audio(audio_source, player, loop):
-    # value, key,
-    """
-    Determine is audio source is uri for text-to speech. E.g.
-    https://translate.google.com/translate_tts?ie=UTF-8&client=tw-ob&tl=
-    en&q=Message one
-    or convert mp3 filename to uri format. E.g. 
-    file:///home/ian1/Desktop/audio/hello.mp3
-    set playbin property and state to playing.
-    Enter loop waiting for audio to finish.
-    Set the state to Null. 
-    """
-    if Gst.uri_is_valid(audio_source):
-        uri = audio_source
-    else:
-        uri = Gst.filename_to_uri(audio_source)
+    def store(self, key, data, extension="mp3"):
+        """
+        Atomically write the audio data to the cache and return its path.
+        Evict the least recently used clips if over the size cap.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except OSError:
+            os.remove(temp_path)
+            raise
+        return self.store_file(key, temp_path, extension)
 
-    player.set_property('uri', uri)
+    def store_file(self, key, temp_path, extension="mp3"):
+        """
+        Move a temporary file written in the cache folder into the cache and
+        return its path. Evict the least recently used clips if over the 
+        size cap.
+        """
+        filename = "{}.{}".format(key, extension)
+        path = os.path.join(self.directory, filename)
+        try:
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+        with self.lock:
+            old = self.index.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.index[key] = [filename, size]
+            self.total_bytes += size
+            self.evict()
+        return path
 
-    # Start streaming the audio.
-    player.set_state(Gst.State.PLAYING)
-    # Loop while waiting for audio to finish. 
-    loop.run()
-    # On exiting loop() set playbin state to Null.
-    player.set_state(Gst.State.NULL)
+    def evict(self):
+        """Delete least recently used clips until under the size cap."""
+        # Never evict the clip that has just been stored.
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            key, (filename, size) = self.index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
 
 
-def bus_call(bus, message, loop):
+def speech_file(message, language, cache=None, backend=None, 
+                streaming=False):
     """
-    Call back for messages generated when playbin is playing.
-    The End-of-Stream, EOS, message indicates the audio is complete and the
-    waiting loop is quit.
+    Return the path of the audio file for the message in the language, the
+    ArchiveClip if it is in the packed archive, or a SpeechClip if it 
+    could not be written to the cache.
+    The archive and the cache are checked first. On a miss the speech is
+    synthesized by the backend and stored in the cache. If streaming, a 
+    StreamingClip is returned as soon as the first of the speech arrives.
+    If the backend fails its fallback local engine is used.
+    Returns None if the speech could not be synthesized.
     """
-    t = message.type
-    if t == Gst.MessageType.EOS:
-        # End-of-Stream therefore quit loop which executes playbin state Null
-        #sys.stdout.write("End-of-stream\n")
-        loop.quit()
+    if cache is None:
+        cache = audio_cache
+    if backend is None:
+        backend = audio_backend
+    key = cache.make_key(message, language, backend.name)
+    if audio_archive is not None:
+        clip = audio_archive.speech(key)
+        if clip is not None:
+            return clip
+    path = cache.path(key)
+    if path is not None:
+        return path
+    # The same clip may be requested again while it is being fetched, e.g.
+    # after a seek. Only one request goes to the backend.
+    with cache.key_lock(key):
+        path = cache.path(key, count=False)
+        if path is not None:
+            with cache.lock:
+                cache.shared += 1
+            return path
+        with cache.lock:
+            clip = cache.streams.get(key)
+            if clip is not None:
+                cache.shared += 1
+        if clip is not None:
+            # Already streaming. Share the clip, or wait for it to be 
+            # cached.
+            if streaming:
+                return clip
+            clip.done.wait()
+            if clip.path is not None:
+                return clip.path
+        if streaming:
+            clip = StreamingClip(key, backend.stream(message, language),
+                                 cache, backend.extension)
+            clip.first_byte.wait(backend.deadline)
+            if clip.ttfb is None:
+                # The late download is not kept.
+                clip.cancel()
+                return fall_back(message, language, cache, backend)
+            return clip
+        try:
+            with tracer.span("tts fetch", "tts", backend=backend.name,
+                             language=language, chars=len(message)):
+                audio_data = backend.synthesize(message, language)
+        except SynthesisError as e:
+            print("Failed to synthesize speech: {}".format(e))
+            return fall_back(message, language, cache, backend)
+        except Exception as e:
+            # A fault in a backend must not end the show. This may be 
+            # running for the playback engine's streaming thread.
+            print("Failed to synthesize speech: {!r}".format(e))
+            return fall_back(message, language, cache, backend)
+        try:
+            return cache.store(key, audio_data, backend.extension)
+        except OSError as e:
+            # E.g. the disk is full. Play the speech from memory.
+            print("Unable to cache the speech: {}".format(e))
+            return SpeechClip(key, audio_data)
 
-    elif t == Gst.MessageType.ERROR:
-        err, debug = message.parse_error()
-        # TODO: If error then re-try last message
-        sys.stderr.write("Error: %s: %s\n" % (err, debug))
-        loop.quit()
-    return True
+
+def fall_back(message, language, cache, backend):
+    """
+    Return the audio file of the message spoken by the fallback local 
+    engine of the backend, or None if it has none. It is cached under the
+    engine's own key, so the backend is asked again next time.
+    """
+    if backend.fallback is None:
+        return None
+    with backend.lock:
+        backend.fallbacks += 1
+    print("Speaking with {} instead.".format(backend.fallback.name))
+    return speech_file(message, language, cache, backend.fallback)
 
 
-#------------------------------------------------------------------------------ 
-#   Launch functions - A collection of functions used before passing to main()
 #------------------------------------------------------------------------------
-def select_audio_player(mp3_player_list, mp3_player):
+#   Music asset cache
+#------------------------------------------------------------------------------
+class DecodeError(Exception):
+    """Raised when a music file can not be decoded."""
+
+
+def decode_to_pcm(file_path, output_path):
     """
-    Provide selection of the mp3 player application to use.
-    Based on items in mp3_player_list. Set mp3_player.
+    Decode an audio file to raw audio in the pcm_caps format, written to 
+    output_path. Raises DecodeError if it fails.
     """
-    while True:
-        print("Select the mp3 player application...")
-        for index, item in enumerate(mp3_player_list):
-            print("\t{}. {}".format(index, item))
-        response = input("Select desired mp3 player [{}]: ".format(mp3_player))
-        if response == "":
-            response = mp3_player
-            break
-        else:
-            try: 
-                response = abs(int(response))
-                mp3_player = mp3_player_list[response]
-                break
-            except:
-                print("Invalid response. Please re-enter...")
-                continue            
-    print("MP3 data will be reproduced as audio with the application {}."
-          .format(mp3_player))
-    return mp3_player
+    pipeline = Gst.parse_launch(
+            "filesrc name=source ! decodebin ! audioconvert ! audioresample "
+            "! {} ! filesink name=sink".format(pcm_caps))
+    pipeline.get_by_name("source").set_property("location", file_path)
+    pipeline.get_by_name("sink").set_property("location", output_path)
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(
+            Gst.CLOCK_TIME_NONE, 
+            Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message is None:
+        raise DecodeError("decoding did not finish")
+    if message.type == Gst.MessageType.ERROR:
+        err, debug = message.parse_error()
+        raise DecodeError(err.message)
 
- 
-def audio_test():
-    """ 
-    Test audio. 
-    """
-    while True:
-        print("Audio level check...")   
-        message = "Audio level check." # One, two, three. Check."
-        text_to_speech(message, 'en')
-        response = input("Audio level OK? [Yes]")
-        if response == "":
-            break
-        else:
-            if response[0].lower() in ["y", "1", "t"]:
-                break
-            else:
-                continue
 
- 
-def connection_to_libreoffice():
-    """Establish python connection to LibreOffice and return the desktop"""
-    
-    localContext = uno.getComponentContext()
-				       
-    resolver = localContext.ServiceManager.createInstanceWithContext(
-	    "com.sun.star.bridge.UnoUrlResolver", localContext)
-    
-    smgr = resolver.resolve(
-        "uno:socket,host=localhost,port=2002;urp;StarOffice.ServiceManager")
+class AppSource:
+    """
+    Audio held in memory, played by the engine through an appsrc instead
+    of from a file. data is a buffer of the audio. If caps is None the 
+    audio is encoded, e.g. mp3, and is found and decoded by playbin. Raw
+    audio has caps and its bytes_per_second, for the timestamps.
+    """
+    name = ""
+    caps = None
+    bytes_per_second = None
+    # Bytes pushed to the appsrc at a time.
+    chunk_bytes = 64 * 1024
 
-    # Alternative port 8100
-    #smgr = resolver.resolve(
-    #    "uno:socket,host=localhost,port=8100;urp;StarOffice.ServiceManager")
-    
-    remoteContext = smgr.getPropertyValue("DefaultContext")
+    def __str__(self):
+        return self.name
 
-    desktop = smgr.createInstanceWithContext("com.sun.star.frame.Desktop",
-            remoteContext)
+    def feed(self, appsrc):
+        """Set up the appsrc to play the audio, pushed as it is needed."""
+        data = self.data
+        if self.caps is not None:
+            appsrc.set_property("caps", Gst.Caps.from_string(self.caps))
+            appsrc.set_property("format", Gst.Format.TIME)
+        else:
+            appsrc.set_property("size", len(data))
+        offset = [0]
 
-    return desktop
-        
-    #Alternative variable naming:
-    #mycontext = uno.getComponentContext()
-    #resolver = mycontext.ServiceManager.createInstanceWithContext
-    #    ("com.sun.star.bridge.UnoUrlResolver", mycontext)
-    #myapi = resolver.resolve
-    #    ("uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext")
+        def need_data(appsrc, length):
+            start = offset[0]
+            if start >= len(data):
+                appsrc.emit("end-of-stream")
+                return
+            chunk = data[start:start + self.chunk_bytes]
+            offset[0] = start + len(chunk)
+            buffer = Gst.Buffer.new_wrapped(bytes(chunk))
+            if self.bytes_per_second is not None:
+                buffer.pts = start * Gst.SECOND // self.bytes_per_second
+                buffer.duration = (len(chunk) * Gst.SECOND // 
+                                   self.bytes_per_second)
+            appsrc.emit("push-buffer", buffer)
 
+        appsrc.connect("need-data", need_data)
 
-def open_impress_document(desktop, presentation): 
-    """Open an existing Impress document."""
-    return desktop.loadComponentFromURL(presentation,"_blank", 0, () )
-    
 
-def read_text_file(text_file_path):
+class PCMAsset(AppSource):
     """
-    Read the text file for the control of the presentation.
+    A music file decoded to raw audio, memory mapped from the music cache.
+    Played by the engine through an appsrc, so no decoder is started.
     """
-    try:
-        with open(text_file_path,"r") as f:
-            # Read to a list without the \n's at the end of lines.
-            return f.read().splitlines()
-    except FileNotFoundError as e:
-        print("Attempted to open text file for the slide presentation.")
-        print("FileNotFoundError: {}".format(e.strerror))
-        print("The path or file is invalid: {}".format(e.filename))
-        sys.exit("Exiting...")
+    caps = pcm_caps
+    bytes_per_second = pcm_bytes_per_second
+    # One second of audio.
+    chunk_bytes = pcm_bytes_per_second
 
+    def __init__(self, file_name, path):
+        self.name = file_name
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.duration = len(self.data) / pcm_bytes_per_second
 
-def get_slide_show_filename(slide_data_list):
+
+class MusicCache:
     """
-    Get the path and filename for the presentation.
-    The path is expected to not be supplied.
-    The current working directory is used as a path.
-    Be able to accept whitespace and uppercase.
-    Skip comment lines and blank lines.
+    Decoded raw audio of the music files, so a jingle played many times is
+    only decoded once.
+    Each file is decoded in a background thread the first time it is seen
+    and played from the file until the decode is done. The raw audio is 
+    kept in pcm_cache_dir, keyed by the path, size and modification time 
+    of the music file, within a byte budget, least recently used removed
+    first. Files are memory mapped when first played.
     """
-    for item in slide_data_list:
-        # Ignore blank and comment lines
-        if len(item) == 0:
-            continue
-        if len(item) > 0 and item[0] == "#":
-            continue
+    def __init__(self, directory=pcm_cache_dir, max_bytes=pcm_max_bytes):
+        Gst.init(None)
+        self.files = AudioCache(directory, max_bytes)
+        self.assets = {}
+        self.decoding = set()
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
-        if ("slide_show_file" in item and ":" in item and "[" in item and
-             "]" in item):
-            temp = item.strip(' \t\n\r[]')
-            filename = temp.split(":")[1].strip()
-            #print("|" + filename + "|")
-            if filename == "":
-                print("No file name supplied for [slide_show_file: ].")
-                sys.exit("Exiting...")
-            filename_path = "{}{}{}".format(os.getcwd(), os.sep, filename)
-            # Test if file can be opened. Return file path and name if it can...
-            try:
-                with open(filename_path,"r") as f:
-                    return filename, filename_path
-            except FileNotFoundError as e:
-                print("Attempted to open the slide presentation file.")
-                print("FileNotFoundError: {}".format(e.strerror))
-                print("The path or file is invalid: {}".format(e.filename))
-                sys.exit("Exiting...")
+    def make_key(self, file_name):
+        """Return the cache key of a music file. Raises OSError."""
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        return self.files.make_key(
+                "{} {} {}".format(path, stat.st_size, stat.st_mtime_ns),
+                "pcm", pcm_caps)
 
-    print("[slide_show_file: ] command not found." )
-    sys.exit("Exiting...")
+    def source(self, file_name):
+        """
+        Return the decoded asset for a music file, or the file name if it 
+        is not decoded yet.
+        """
+        try:
+            key = self.make_key(file_name)
+        except OSError:
+            return file_name
+        path = self.files.path(key)
+        with self.lock:
+            if path is None:
+                # Not decoded, or removed to stay in the budget.
+                self.assets.pop(key, None)
+            else:
+                asset = self.assets.get(key)
+                if asset is None:
+                    try:
+                        asset = PCMAsset(file_name, path)
+                    except (OSError, ValueError):
+                        # Removed, or empty. Play from the file.
+                        return file_name
+                    self.assets[key] = asset
+                return asset
+        self.decode(file_name, key)
+        return file_name
+
+    def decode(self, file_name, key):
+        """Decode the music file in the background, once."""
+        with self.lock:
+            if key in self.decoding or key in self.failed:
+                return
+            self.decoding.add(key)
+        self.executor.submit(self.decode_file, file_name, key)
 
+    def decode_file(self, file_name, key):
+        fd, temp_path = tempfile.mkstemp(dir=self.files.directory, 
+                                         suffix=".tmp")
+        os.close(fd)
+        try:
+            with tracer.span("decode music", "music", source=file_name):
+                decode_to_pcm(file_name, temp_path)
+            self.files.store_file(key, temp_path, "pcm")
+        except (DecodeError, OSError) as e:
+            print("Unable to decode {}, playing it from the file: {}"
+                  .format(file_name, e))
+            with self.lock:
+                self.failed.add(key)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        finally:
+            with self.lock:
+                self.decoding.discard(key)
 
-def check_slide_command(slide_data_list, max_slide, oDoc, text_file):
+    def warm(self, control_dict):
+        """Start decoding the music files of the show that are not cached."""
+        for slide_list in control_dict.values():
+            for item in slide_list:
+                if item[0] == "music" and not archived_music(item[1]):
+                    try:
+                        key = self.make_key(item[1])
+                    except OSError:
+                        continue
+                    if self.files.path(key, count=False) is None:
+                        self.decode(item[1], key)
+
+    def shutdown(self, wait=False):
+        """Stop the decoding thread, waiting for it to finish if wait."""
+        self.executor.shutdown(wait=wait)
+
+
+def music_source(file_name):
     """
-    Knowing the total number of slides in the presentation.
-    Check the [slide:x] commands are valid. i.e. Is an integer in range.
-    If error, provide error message and exit.
-    Some slides may be displayed more that once.
-    Return the number of slides that will be displayed.
+    Return what to play for a music file: from the archive, decoded if it
+    is cached, or the file.
     """
-    line_number = 0
-    counter = 0
-    for item in slide_data_list:
-        line_number +=1
-        # Ignore blank lines
-        if len(item) == 0:
-            continue
-        # Ignore comment and text. In case command found in the comments.
-        if not item[0] == "[":
-            continue
+    if audio_archive is not None:
+        clip = audio_archive.music(file_name)
+        if clip is not None:
+            return clip
+    if music_cache is None:
+        return file_name
+    return music_cache.source(file_name)
 
-        if "[slide:" in item.lower() and "]" in item:
-            temp = item.strip(' \t\n\r[]')
-            slide_number = temp.split(":")[1].strip()
-            #print("|" + slide_number + "|")
-            try:
-                slide_number = int(slide_number)
-            except ValueError as e:
-                print("\nError in file {} at line number: {}"
-                      .format(text_file, line_number))
-                print("{}".format(item))
-                print("Slide number {} is not an integer".format(slide_number))
-                oDoc.dispose()
-                sys.exit("Exiting...")
 
-            if slide_number > max_slide:
-                print("\nError in file {} at line number: {}"
-                      .format(text_file, line_number))
-                print("{}".format(item))
-                print("Slide number {} exceeds total slides of {}"
-                      .format(slide_number, max_slide))
-                oDoc.dispose()
-                sys.exit("Exiting...")
+#------------------------------------------------------------------------------
+#   Packed audio archive
+#------------------------------------------------------------------------------
+# One file holding every speech clip and music file of a show, to copy to
+# the display machines. Layout, all little-endian:
+#   header
+#   index: one fixed size entry per clip, sorted by id
+#   data: the audio files, one after another
+# The id of a speech clip is its audio cache key, of a music file the sha256
+# of its name as given in the control file.
+def music_id(file_name):
+    """Return the archive id of a music file."""
+    return hashlib.sha256("music\0{}".format(file_name)
+                          .encode("utf-8")).digest()
 
-            if slide_number < 1:
-                print("\nError in file {} at line number: {}"
-                      .format(text_file, line_number))
-                print("{}".format(item))
-                print("Slide number {} is less than first slide number of 1."
-                      .format(slide_number))
-                oDoc.dispose()
-                sys.exit("Exiting...") 
 
-            counter +=1
-    return counter
+def archived_music(file_name):
+    """Return True if the music file is packed in the audio archive."""
+    return (audio_archive is not None and 
+            audio_archive.find(music_id(file_name)) is not None)
 
 
-def check_music_command(slide_data_list, max_slide, oDoc, text_file):
+class ArchiveClip(AppSource):
     """
-    Knowing the total number of slides in the presentation.
-    Check the [music:x] commands are valid. i.e. Is a file with mp3 extension.
-    If error, provide error message and exit.
-    Some slides may be displayed more that once.
-    Return the number of slides that will be displayed.
+    A clip in the packed archive. Its data is a slice of the memory mapped
+    archive, not a copy.
     """
-    line_number = 0
-    counter = 0
-    for item in slide_data_list:
-        line_number +=1
-        # Ignore blank lines
-        if len(item) == 0:
-            continue
-        # Ignore comment and text. In case command found in the comments.
-        if not item[0] == "[":
-            continue
+    def __init__(self, name, data, codec, duration):
+        self.name = name
+        self.data = data
+        self.codec = codec
+        self.duration = duration
 
-        if "[music:" in item.lower() and "]" in item:
-            temp = item.strip(' \t\n\r[]')
-            filename = temp.split(":")[1].strip()
-            #print("|" + slide_number + "|")
-            #filename = hello.mp3
-            filename_list = filename.split(".")
-            #print(filename_list)
-            #print(filename_list[-1])
 
-            try:
-                # Try opening the file
-                f = open(filename, "r")
-                f.close()
+class SpeechClip(AppSource):
+    """Speech held in memory, when it could not be written to the cache."""
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
 
-            except ValueError as e:
-                print("\nError in file {} at line number: {}"
-                      .format(text_file, line_number))
-                print("{}".format(item))
-                print("music file {} is not valie".format(slide_number))
-                oDoc.dispose()
-                sys.exit("Exiting...")
 
-            if filename_list[-1] != "mp3" and filename_list[-1] != "wav":
-                print("\nError in file {} at line number: {}"
-                      .format(filename, line_number))
-                print("{}".format(item))
-                print("Music file {} does not have .mp3 or .wav extension"
-                      .format(filename))
-                oDoc.dispose()
-                sys.exit("Exiting...")
+class PackedArchive:
+    """
+    Memory mapped packed archive. Clips are found by a binary search of the
+    index, with no file opened or looked up per clip.
+    """
+    def __init__(self, file_path):
+        """Raises ValueError if the file is not an archive."""
+        with open(file_path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buf) < archive_header.size:
+            raise ValueError("{} is too short".format(file_path))
+        magic, version, self.count = archive_header.unpack_from(self.buf)
+        if magic != archive_magic or version != archive_version:
+            raise ValueError("{} is not a version {} archive"
+                             .format(file_path, archive_version))
+        self.view = memoryview(self.buf)
+
+    def find(self, clip_id):
+        """Return the index entry for the id, or None."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = archive_header.size + middle * archive_entry.size
+            entry_id = self.buf[offset:offset + 32]
+            if entry_id == clip_id:
+                return archive_entry.unpack_from(self.buf, offset)
+            if entry_id < clip_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def clip(self, clip_id, name):
+        """Return the ArchiveClip for the id, or None."""
+        entry = self.find(clip_id)
+        if entry is None:
+            return None
+        entry_id, offset, length, codec, duration = entry
+        return ArchiveClip(name, self.view[offset:offset + length],
+                           codec.rstrip(b"\0").decode("ascii"), duration)
 
-            counter +=1
-    return counter
+    def speech(self, key):
+        """Return the clip for an audio cache key, or None."""
+        return self.clip(bytes.fromhex(key), key)
 
+    def music(self, file_name):
+        """Return the clip for a music file, or None."""
+        return self.clip(music_id(file_name), file_name)
 
-def check_pause_command(slide_data_list, max_slide, oDoc, text_file):
+
+def write_archive(file_path, clips):
     """
-    Check the [pause:x] commands are valid. i.e. Is an integer in range.
-    If error, provide error message and exit.
-    Return the number of pause commands.
+    Write the packed archive. clips is a list of (id, file path, duration).
+    The codec is taken from the file extension. Written to a temporary file
+    and renamed.
     """
-    line_number = 0
-    counter = 0
-    for item in slide_data_list:
-        line_number +=1
-        # Ignore blank lines
-        if len(item) == 0:
-            continue
-        # Ignore comment and text. In case command found in the comments.
-        if not item[0] == "[":
-            continue
+    clips = sorted(clips)
+    offset = archive_header.size + len(clips) * archive_entry.size
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(archive_header.pack(archive_magic, archive_version,
+                                        len(clips)))
+            for clip_id, path, duration in clips:
+                length = os.path.getsize(path)
+                codec = path.rsplit(".", 1)[-1].lower().encode("ascii")
+                f.write(archive_entry.pack(clip_id, offset, length, codec,
+                                           duration))
+                offset += length
+            for clip_id, path, duration in clips:
+                with open(path, "rb") as clip_file:
+                    f.write(clip_file.read())
+        os.replace(temp_path, file_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+    return offset
 
-        if "[pause:" in item.lower() and "]" in item:
-            temp = item.strip(' \t\n\r[]')
-            pause_value = temp.split(":")[1].strip()
-            #print("|" + pause_value + "|")
-            try:
-                pause_value = float(pause_value)
-            except ValueError as e:
-                print("\nError in file {} at line number: {}"
-                      .format(text_file, line_number))
-                print("{}".format(item))
-                print("Pause value {} is not a float".format(pause_value))
-                oDoc.dispose()
-                sys.exit("Exiting...")
 
-            if pause_value < 0:
-                print("\nError in file {} at line number: {}"
-                      .format(text_file, line_number))
-                print("{}".format(item))
-                print("Pause {} is negative value."
-                      .format(pause_value))
-                oDoc.dispose()
-                sys.exit("Exiting...") 
-
-            counter +=1
-    return counter
-
-
-def check_language_command(slide_data_list, language_code_dict, oDoc,
-                           text_file):
-    """
-    Check the [language:x] commands are valid.
-    If error, provide error message and exit.
-    Return the number of language commands.
-    """
-    line_number = 0
-    counter = 0
-    for index, item in enumerate(slide_data_list):
-        line_number +=1
-        # Ignore blank lines
-        if len(item) == 0:
-            continue
-        # Ignore comment and text. In case command found in the comments.
-        if not item[0] == "[":
-            continue
+def export_archive(text_file_path, archive_path, args):
+    """
+    Synthesize any speech not yet cached and pack every speech clip and 
+    music file of the show into one archive, with the duration of each.
+    Return the number of failures.
+    """
+    impress_file, total_slide, control_dict, totals, control_hash = (
+            load_control(text_file_path))
+    cache, backend = make_speech_stack(args)
+    clips, chars, failures = batch_synthesize(control_dict, cache, backend,
+                                              args.synthesis_workers)
+    if failures:
+        print_errors(failures, os.path.basename(text_file_path))
+        return len(failures)
 
-        if "[language:" in item.lower() and "]" in item:
-            temp = item.strip(' \t\n\r[]')
-            language_string = temp.split(":")[1].strip()
-            #print("|" + pause_value + "|")
-            try:
-                # try to get the language code. If so, insert code in list
-                language_code = language_code_dict[language_string]
-                language_pop = slide_data_list.pop(index)
-                temp = "[language:{}]".format(language_code)
-                slide_data_list.insert(index, temp )
+    files = {}
+    for index in range(len(control_dict)):
+        for item in control_dict[index]:
+            if item[0] == "music":
+                files[music_id(item[1])] = item[1]
+            elif is_text_item(item[0]):
+                for chunk in split_text(item[1], item[0]):
+                    key = cache.make_key(chunk, item[0], backend.name)
+                    path = cache.path(key, count=False)
+                    if path is None:
+                        failures.append([item[2], item, 
+                                         "The speech is not in the cache."])
+                        continue
+                    files[bytes.fromhex(key)] = path
+    if failures:
+        print_errors(failures, os.path.basename(text_file_path))
+        return len(failures)
 
-            except KeyError:
-                print("\nError in file {} at line number: {}"
-                      .format(text_file, line_number))
-                print("{}".format(item))
-                print("Language of '{}' is not valid".format(language_string))
-                oDoc.dispose()
-                sys.exit("Exiting...")
-  
-            counter +=1
-    return counter, slide_data_list
+    discoverer = GstPbutils.Discoverer.new(10 * Gst.SECOND)
+    entries = []
+    for clip_id, path in files.items():
+        try:
+            codec, duration = probe_audio(path, discoverer)
+        except ProbeError as e:
+            print("Unable to probe {}: {}".format(path, e))
+            duration = 0.0
+        entries.append((clip_id, path, duration))
+    size = write_archive(archive_path, entries)
+    print("Packed {} clips, {:.1f} MB, into {}".format(
+            len(entries), size / (1024 * 1024), archive_path))
+    return 0
 
 
-def built_control_dict_template(slide_total_displayed):
+#------------------------------------------------------------------------------
+#   Streamed speech
+#------------------------------------------------------------------------------
+class StreamingClip(AppSource):
     """
-    Build the template for the control dictionary.
-    Dictionary has a integer key for each slide displayed 
-    {0: [], 1: [], 2: [], 3: []}
+    Speech played while it is still being fetched. A thread reads the 
+    backend's response into a bounded queue of chunks, which the player
+    takes from as it needs them. While the queue is full the thread waits,
+    so the download keeps only a little ahead of the playing. The chunks
+    are also written to a temporary file, moved into the cache once the
+    clip is complete.
+    If the queue stays full for stall_timeout seconds the clip is not being
+    played yet. The rest is downloaded to the cache without waiting, so the
+    connection is freed, and the player reads it from the cache file.
+    While in flight the clip is registered in the cache's streams, so a
+    second request for the same speech is given this clip, not a second
+    download. Only the first reader takes the chunks as they arrive. Later
+    readers, e.g. of a repeated paragraph, read the cache file once it is
+    complete.
+    Records the time to the first byte. The engine records the time to the
+    first audio. Both in milliseconds from the request.
     """
-    control_dict = {}
-    for i in range(slide_total_displayed):
-        control_dict.update({i: []})
-    return control_dict
-    
+    def __init__(self, key, chunks, cache, extension="mp3",
+                 buffer_chunks=speech_buffer_chunks,
+                 stall_timeout=speech_stall_timeout):
+        self.name = key
+        self.key = key
+        self.cache = cache
+        self.extension = extension
+        self.stall_timeout = stall_timeout
+        self.queue = queue.Queue(maxsize=buffer_chunks)
+        self.start = time.monotonic()
+        self.first_byte = threading.Event()
+        self.done = threading.Event()
+        self.ttfb = None
+        self.ttfa = None
+        self.error = None
+        self.spilled = False
+        self.cancelled = False
+        self.claimed = False
+        self.lock = threading.Lock()
+        # The cache file, once complete, and the bytes played so far.
+        self.path = None
+        self.offset = 0
+        with cache.lock:
+            cache.streams[key] = self
+        thread = threading.Thread(target=self.download, args=(chunks,),
+                                  daemon=True)
+        thread.start()
 
-def built_control(slide_data_list, control_dict, slide_total_displayed, oDoc):
-    """
-    Insert the control data and text into the control_dict.
-    For each slide in the dictionary, use lists within lists.
-    Key value lists will be like this...
-    [['slide':1], ['en': 'This is slide 1'], ['pause':2], ['fr': 'bonjour']...] 
-    A paragraph of text may span multiple lines. A blank line or a command 
-    terminates the paragraph.
-    """
-    line_number = 0
-    counter = -1
-    boo_text =  False
-    language_code = "en"
-    temp_text = ""
-    for index, item in enumerate(slide_data_list):
-        line_number +=1
-        # Clear spaces from front and rear of line
-        # When determined to be text then add a space at end of line.
-        item = item.strip(' \t\n\r')
+    def download(self, chunks):
+        """Read the chunks to the queue and the cache. Runs on a thread."""
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.cache.directory,
+                                             suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    if self.cancelled:
+                        break
+                    if self.ttfb is None:
+                        now = time.monotonic()
+                        self.ttfb = (now - self.start) * 1000
+                        tracer.complete("time to first byte", "tts", 
+                                        self.start, now, clip=self.key)
+                        self.first_byte.set()
+                    f.write(chunk)
+                    if not self.spilled:
+                        self.put(chunk)
+            if not self.cancelled:
+                self.path = self.cache.store_file(self.key, temp_path,
+                                                  self.extension)
+                temp_path = None
+        except (SynthesisError, OSError) as e:
+            self.error = e
+            print("Failed to synthesize speech: {}".format(e))
+        finally:
+            # Closes the connection of a cancelled download.
+            chunks.close()
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.unregister()
+            self.done.set()
+            self.first_byte.set()
+            if not self.spilled:
+                self.put(None)
 
-        if len(item) == 0:
-            if boo_text:    
-                # update the text with language code as key.
-                control_dict[counter].append([language_code, temp_text])
-                boo_text = False
-                temp_text = ""
-                continue
+    def unregister(self):
+        """Remove the clip from the cache's streams in flight."""
+        with self.cache.lock:
+            if self.cache.streams.get(self.key) is self:
+                del self.cache.streams[self.key]
 
-            else:
-                #Extra blank line - Do nothing"
+    def cancel(self):
+        """
+        Give up on the download, e.g. when the deadline has passed and the
+        speech is made by the fallback engine instead. Nothing is cached.
+        """
+        self.cancelled = True
+        self.unregister()
+
+    def put(self, chunk):
+        """Queue a chunk, or give up on the queue if it stays full."""
+        try:
+            self.queue.put(chunk, timeout=self.stall_timeout)
+        except queue.Full:
+            self.spilled = True
+
+    def read(self):
+        """
+        Return the next chunk of the audio, waiting for it to arrive, or
+        b'' at the end.
+        """
+        while True:
+            try:
+                chunk = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.spilled and self.done.is_set():
+                    chunk = self.read_file(self.offset)
+                    self.offset += len(chunk)
+                    return chunk
                 continue
-        
-        # Lines that have content.
-        # Ignore comment lines
-        if item[0] == "#":
-            #print(item)
-            continue
-        
-        # Slide command
-        if item[0] =="[" and "[slide:" in item.lower() and "]" in item:
-            if boo_text:    
-                # update the text with language code as key.
-                control_dict[counter].append([language_code, temp_text])
-                boo_text = False
-                temp_text = ""
-            temp = item.strip(' \t\n\r[]')
-            slide_number = int(temp.split(":")[1].strip())
-            # Update the main key of the control_dict
-            counter +=1
-            control_dict[counter].append(['slide', slide_number])
-            continue
+            if chunk is None:
+                return b""
+            self.offset += len(chunk)
+            return chunk
 
-        # music command
-        if item[0] =="[" and "[music:" in item.lower() and "]" in item:
-            if boo_text:    
-                # update the text with language code as key.
-                control_dict[counter].append([language_code, temp_text])
-                boo_text = False
-                temp_text = ""
-            temp = item.strip(' \t\n\r[]')
-            filename = temp.split(":")[1].strip()
-            # Update the main key of the control_dict
-            #print(filename)
-            control_dict[counter].append(['music', filename])
-            continue
+    def read_file(self, offset):
+        """Return the chunk of the cache file at offset, or b''."""
+        if self.path is None:
+            return b""
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                return f.read(self.chunk_bytes)
+        except FileNotFoundError:
+            return b""
 
-        # Pause command
-        if item[0] =="[" and "[pause:" in item.lower() and "]" in item:
-            if boo_text:    
-                # update the text with language code as key.
-                control_dict[counter].append([language_code, temp_text])
-                boo_text = False
-                temp_text = ""
-            temp = item.strip(' \t\n\r[]')
-            pause_value = float(temp.split(":")[1].strip())
-            control_dict[counter].append(['pause', pause_value])
-            continue
+    def reader(self):
+        """
+        Return a function that gives the next chunk of the audio at each
+        call, and b'' at the end. The first reader takes the chunks as they
+        arrive. Later ones wait for the cache file.
+        """
+        with self.lock:
+            first = not self.claimed
+            self.claimed = True
+        if first:
+            return self.read
+        offset = [0]
 
-        # Language command
-        if item[0] =="[" and "[language:" in item.lower() and "]" in item:
-            if boo_text:    
-                # update the text with language code as key.
-                control_dict[counter].append([language_code, temp_text])
-                boo_text = False
-                temp_text = ""
-            temp = item.strip(' \t\n\r[]')
-            language_code = temp.split(":")[1].strip()
-            #print("Language code is now: {}".format(language_code))
-            continue           
-    
-        # slide_show_file command
-        if item[0] =="[" and "[slide_show_file:" in item.lower():
-            # Ignore this command.
-            continue
+        def read_file():
+            self.done.wait()
+            chunk = self.read_file(offset[0])
+            offset[0] += len(chunk)
+            return chunk
 
-        # Miscellaneous. Junked command. 
-        if item[0] =="[" and "]" in item:
-            # Ignore this command.
-            continue
+        return read_file
+
+    def feed(self, appsrc):
+        """Set up the appsrc to push the chunks as they arrive."""
+        read = self.reader()
+
+        def need_data(appsrc, length):
+            chunk = read()
+            if not chunk:
+                appsrc.emit("end-of-stream")
+                return
+            appsrc.emit("push-buffer", Gst.Buffer.new_wrapped(chunk))
+
+        appsrc.connect("need-data", need_data)
 
-        # Item must be text. Build/Append text string.       
-        temp_text = temp_text + item + " "
-        boo_text = True
-        
-    return control_dict
 
-#------------------------------------------------------------------------------
-# OLD To be deleted. This is the version using urllib.
 #------------------------------------------------------------------------------
 #   Audio 
 #------------------------------------------------------------------------------
-def text_to_speech(message='Hello World', language='en', mp3=mp3_player):
+def text_to_speech(message='Hello World', language='en', mp3=mp3_player,
+                   cache=None):
     """
-    Use google translate to do text to speech translation.
+    Get the speech for the message from the audio cache, or from the text
+    to speech backend.
     Use mplayer to play the mp3 data.
     message = text to be converted to speech
     language = en is English, fr is French, de is German, etc.
     """
-    # Build the url string.
-    url = 'https://translate.google.com/translate_tts'
-    user_agent = 'Mozilla'
-    values = {'tl' : language,
-              'client' : 'tw-ob',
-              'ie' : 'UTF-8',
-              'q' : message }
-    data = urllib.parse.urlencode(values)
-    headers = { 'User-Agent' : user_agent }
-
-    req = urllib.request.Request(url + "?" + data, None, headers)
-
     # Select the mp3 player to use...
     if mp3 == "mplayer":
         player = subprocess.Popen \
@@ -721,16 +4636,21 @@ def text_to_speech(message='Hello World', language='en', mp3=mp3_player):
             stdin = subprocess.PIPE
           )   
 
-    # Send the request to google, and send mp3 data to mp3 player.
-    try: 
-        with urllib.request.urlopen(req) as response:
-            mp3_data = response.read()
-            player.stdin.write(mp3_data)
-
-    except urllib.error.URLError as e:
-        print(e)
-        print(e.reason)
-        print(e.read())
+    # Send the mp3 data of each chunk of the message to the mp3 player.
+    for chunk in split_text(message, language):
+        audio_file = speech_file(chunk, language, cache, 
+                                 streaming=speech_streaming)
+        if audio_file is None:
+            continue
+        if isinstance(audio_file, (ArchiveClip, SpeechClip)):
+            player.stdin.write(audio_file.data)
+            continue
+        if isinstance(audio_file, StreamingClip):
+            for data in iter(audio_file.reader(), b""):
+                player.stdin.write(data)
+            continue
+        with open(audio_file, "rb") as f:
+            player.stdin.write(f.read())
 
     player.stdin.close()
     player.wait() # fixme: should check return status
@@ -741,122 +4661,246 @@ def text_to_speech(message='Hello World', language='en', mp3=mp3_player):
 #------------------------------------------------------------------------------ 
 if __name__ == "__main__":
     """
+    Launch LibreOffice and connect to it in the background.
     Select the mp3 application. TODO: Pass as sys.argv[]
-    Test audio level.
-    Call function to establish connection to LibreOffice
     Check the text/control file exists.
-    Read text/control to a list without the \n's at the end of lines.
-    Get slide show default path and filename. Check file exists.
+    Load the compiled plan, if up to date, or read the text/control file,
+    get the slide show filename, check the commands and build the
+    dictionary to control the presentation in one pass.
+    Start fetching the speech for the start of the show.
+    Test audio level.
+    Wait for the connection to LibreOffice.
     Open Impress slide show and return object oDoc.
     Display the slide show default language.
-    Provide information about the slide show. No of slides.
-    Check the slide commands have valid values
-    Check pause commands have a valid amount.
-    Check language commands are valid.
-    Initialize the dictionary to control the presentation.
-    Load data into the dictionary to control the presentation.
-    Start the slide show and instantiate the presentation control object
+    Provide information about the slide show. No of slides. Check the slide
+    numbers and save the compiled plan.
+    Start the slide show and wait for the presentation control object.
+    Print the time taken by each phase of the startup.
     Call the main() function to run the slide show.
     Dispose of the slide show after it has finnished.
     """
 
-    child = subprocess.Popen(args = ("soffice", "--accept=socket,host=localhost,port=2002;urp;StarOffice.ServiceManager"))
+    timer = StartupTimer()
 
-    # TODO: Add sys.argv command line to input the control and text file.
-    if len(sys.argv) > 1:
-        slide_start = int(sys.argv[1])
+    args = parse_arguments()
+    slide_start = args.slide_start
+    tracer.enabled = args.trace is not None
+    speech_streaming = args.stream_speech
+
+    # Music is decoded once and played from memory.
+    if not args.no_music_cache:
+        music_cache = MusicCache(pcm_cache_dir, pcm_max_bytes)
+
+    # The audio packed for the show is played from the archive.
+    if args.archive:
+        try:
+            audio_archive = PackedArchive(args.archive)
+        except (OSError, ValueError) as e:
+            print("Unable to open archive {}: {}".format(args.archive, e))
+            sys.exit("Exiting...")
+        print("Audio archive: {}, {} clips".format(args.archive, 
+                                                   audio_archive.count))
+
+    # With --fleet, run several shows from this process and exit.
+    if args.fleet:
+        run_fleet(args.fleet, args)
+        if args.trace:
+            tracer.write(args.trace)
+            print("Trace written to {}".format(args.trace))
+        sys.exit()
+
+    # With --export-archive, pack the audio of the show, and exit.
+    if args.export_archive:
+        text_file_path = "{}{}{}".format(os.getcwd(), os.sep, text_file)
+        if export_archive(text_file_path, args.export_archive, args):
+            sys.exit("Export failed. Exiting...")
+        sys.exit()
+
+    # With --synthesize-all, fill the cache with the speech, and exit.
+    if args.synthesize_all:
+        text_file_path = "{}{}{}".format(os.getcwd(), os.sep, text_file)
+        if synthesize_all(text_file_path, args):
+            sys.exit("Synthesis failed. Exiting...")
+        sys.exit()
+
+    # With --preflight, check and warm everything for the show, and exit.
+    if args.preflight:
+        text_file_path = "{}{}{}".format(os.getcwd(), os.sep, text_file)
+        if preflight(text_file_path, args):
+            sys.exit("Preflight failed. Exiting...")
+        sys.exit()
+
+    # Launch LibreOffice and connect to it in the background, while the
+    # control file is loaded, the cache warmed and the audio checked.
+    child = launch_office(args.office_connection)
+    startup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    # Set on an error before the connection is made, so that the exit does
+    # not wait for the poll to time out.
+    office_cancel = threading.Event()
+
+    def start_office():
+        with timer.phase("LibreOffice ready"):
+            return wait_for_office(connection=args.office_connection,
+                                   cancel=office_cancel)
+
+    office_future = startup_executor.submit(start_office)
  
     # select the mp3_player to use.
     #mp3_player = select_audio_player(mp3_player_list, mp3_player)
     mp3_player = "mplayer"
     # TODO: Remove mp3_player selection
 
-    # Provide and audio test to set the volume.
-    audio_test()
-
-    # Establish connection to LibreOffice. 
-    oDesktop = connection_to_libreoffice()
+    # Speech is cached on disk. Repeat runs do not go to the network.
+    with timer.phase("Open audio cache"):
+        audio_cache, audio_backend = make_speech_stack(args, args.fallback)
 
     # Open the text/control file. Check for file not found.
     text_file_path = "{}{}{}".format(os.getcwd(), os.sep, text_file)
     #print(text_file_path)
 
-    # Read text/control to a list without the \n's at the end of lines.
-    slide_data_list = read_text_file(text_file_path)
-    #print(slide_data_list)
-  
-    # Get slide show default path and filename and Check file exists. e.g.
-    # [slide_show_file:slide_test_v1.odp]
-    impress_file, impress_file_path = get_slide_show_filename(slide_data_list)
+    # Load the compiled plan, or read and compile the text/control file.
+    # The slide numbers are checked once the presentation is open.
+    # With --stream, only the Impress file name is read now. The file is
+    # parsed while the show is presenting.
+    with timer.phase("Load control file"):
+        try:
+            if args.stream:
+                impress_file, impress_file_path = get_slide_show_filename(
+                        iter_text_file(text_file_path))
+                total_slide = None
+                control_dict = None
+            else:
+                (impress_file, total_slide, control_dict, totals, 
+                 control_hash) = load_control(text_file_path)
+        except SystemExit:
+            office_cancel.set()
+            child.kill()
+            raise
+    impress_file_path = "{}{}{}".format(os.getcwd(), os.sep, impress_file)
     print("Impress presentation: {}".format(impress_file_path))
+
+    # Fetch the speech for the start of the show in the background.
+    def warm_up():
+        with timer.phase("Cache warm-up"):
+            warm_cache(control_dict, slide_start, args.prefetch_depth, 
+                       audio_cache, audio_backend).shutdown(wait=True)
+
+    if not args.stream:
+        warm_future = startup_executor.submit(warm_up)
+        if music_cache is not None:
+            music_cache.warm(control_dict)
+
+    # Provide and audio test to set the volume.
+    with timer.phase("Audio level check"):
+        audio_test()
+
+    # Establish connection to LibreOffice. 
+    with timer.phase("Wait for LibreOffice"):
+        try:
+            oDesktop = office_future.result()
+        except NoConnectException:
+            child.kill()
+            sys.exit("LibreOffice did not accept a connection within {} "
+                     "seconds. Exiting...".format(office_timeout))
  
     # Open existing Impress slide show and return object oDoc.
-    presentation_url = "file:///{}".format(impress_file_path)
-    oDoc = open_impress_document(oDesktop, presentation_url)
-    # If there are errors after this point, dispose of the Impress document.
-    # oDoc.dispose()
+    with timer.phase("Open presentation"):
+        presentation_url = "file:///{}".format(impress_file_path)
+        oDoc = open_impress_document(oDesktop, presentation_url)
+        # If there are errors after this point, dispose of the Impress
+        # document. oDoc.dispose()
 
     # Display the slide show default language.
     print("Default language code: {}".format(default_language_code))
 
-    # Provide information about the slide show. No of slides.
-    total_slide = oDoc.DrawPages.Count
-    print("Total slides in {}: {}".format(impress_file, total_slide))
+    if args.stream:
+        total_slide = oDoc.DrawPages.Count
+        print("Total slides in {}: {}".format(impress_file, total_slide))
+        # Start parsing the text/control file in the background.
+        control_dict = BlockStream(text_file_path, total_slide,
+                                   args.stream_window)
+        print("Streaming control file: {}".format(text_file))
 
-    # Check the slide commands are valid for the slides in the presentation.
-    # Count the total calls for slides to be shown.
-    # Of all the slides some may not be shown others may be shown twice, etc.
-    slide_total_displayed = check_slide_command(slide_data_list, total_slide,
-                                                oDoc, text_file)
-    print("Total slides to be displayed: {}".format(slide_total_displayed))
-
-    music_total = check_music_command(slide_data_list, total_slide, oDoc,
-                                      text_file)
-    print("Total music files to be played: {}".format(music_total))
-
-    # Check pause commands have a valid amount. Integer or float.
-    pause_total = check_pause_command(slide_data_list, total_slide, oDoc,
-                                      text_file)
-    print("Total Pause commands: {}".format(pause_total))
-
-    # Check language commands are valid.
-    # Convert to language code: '[language:French]' becomes '[language:fr]'
-    # All use two letter code en, fr, etc., except chinese zh-TW, zh-CN.
-    # Update: slide_data_list with modified language commands.
-    #print(slide_data_list)
-    language_total, slide_data_list = check_language_command(slide_data_list,
-                                                          language_code_dict,
-                                                          oDoc,
-                                                          text_file)        
-    print("Total Language commands: {}".format(language_total))
-    #print(slide_data_list)
-    # Command data has been verified as OK. 
+    elif total_slide is None:
+        # Provide information about the slide show. No of slides.
+        total_slide = oDoc.DrawPages.Count
+        errors = check_slide_range(control_dict, total_slide)
+        if errors:
+            print_errors(errors, text_file)
+            oDoc.dispose()
+            child.kill()
+            sys.exit("Exiting...")
+        # Save the compiled plan for the next launch.
+        write_plan(plan_path(text_file_path), control_hash, impress_file,
+                   total_slide, control_dict, totals)
+    if not args.stream:
+        print("Total slides in {}: {}".format(impress_file, total_slide))
+
+        print("Total slides to be displayed: {}".format(totals["slide"]))
+        print("Total music files to be played: {}".format(totals["music"]))
+        print("Total Pause commands: {}".format(totals["pause"]))
+        print("Total Language commands: {}".format(totals["language"]))
+        # Command data has been verified as OK. 
+        #print(control_dict)
 
-    # Build the dictionary to control the presentation.
-    control_dict = built_control_dict_template(slide_total_displayed)
-    #print(control_dict) #{0: [], 1: [], 2: [], 3: []}
+        with timer.phase("Wait for cache warm-up"):
+            warm_future.result()
 
-    control_dict = built_control(slide_data_list, control_dict,
-                                 slide_total_displayed, oDoc)
-    #print(control_dict)
+    # With --timeline, fetch all the speech and measure the audio to plan
+    # the start time of every slide block.
+    timeline = None
+    if args.timeline:
+        with timer.phase("Measure timeline"):
+            durations, music, failures = measure_durations(
+                    control_dict, audio_cache, audio_backend)
+        if failures:
+            print_errors(failures, text_file)
+        timeline = Timeline(control_dict, durations)
+        print("Planned show duration: {}".format(format_clock(timeline.end)))
+    startup_executor.shutdown()
 
     #response = input("Paused. Hit return to start slide show.")
     # Start the slide show and instantiate the presentation control object
-    oDoc.Presentation.start()
-    # Allow time to launch
-    time.sleep(3)
-    oControl = oDoc.Presentation.getController()
+    # once it is running.
+    with timer.phase("Start slide show"):
+        oDoc.Presentation.start()
+        oControl = wait_for_presentation(oDoc)
+    if oControl is None:
+        oDoc.dispose()
+        child.kill()
+        sys.exit("Slide show did not start within {} seconds. Exiting..."
+                 .format(presentation_timeout))
 
     print("Slide Show is running: {}".format(oDoc.Presentation.isRunning()))
+    timer.report()
 
-
+    # With --watch, changes to the text/control file are loaded into the 
+    # show as it runs.
+    # With --interactive, the show can be moved to any slide.
+    if args.watch or args.interactive:
+        control_dict = LivePlan(control_dict)
+    if args.watch:
+        watcher = ControlWatcher(text_file_path, impress_file, total_slide,
+                                 control_dict, audio_cache, audio_backend)
+        print("Watching {} for changes.".format(text_file))
 
     # Call the main() function to run the slide show.
-    main(control_dict, oDoc, oControl, mp3_player, slide_start)
+    main(control_dict, oDoc, oControl, mp3_player, slide_start, audio_cache,
+         args.prefetch_depth, audio_backend, interactive=args.interactive,
+         asynchronous=args.asyncio, timeline=timeline)
+
+    if args.watch:
+        watcher.stop()
+
+    if args.trace:
+        tracer.write(args.trace)
+        print("Trace written to {}".format(args.trace))
+        tracer.print_summary()
+
+    if music_cache is not None:
+        music_cache.shutdown()
 
     # Dispose of the slide show after it has finnished.
     oDoc.dispose()
     child.kill()
     sys.exit()
-
-